@@ -0,0 +1,123 @@
+import heapq
+import re
+import threading
+import time
+
+import menu
+
+
+BUCKET_SECONDS = 15 * 60
+CHART_BUCKETS = 16
+TOP_ITEMS = 10
+BAR_WIDTH = 12
+NAME_LIMIT = 40
+# Counter of the ordered items that are not in the menu
+OTHER_ITEM = 'i:'
+
+# Set up with the dispatcher to the persistence
+store = None
+# Sales rollups per party id as flat counters: revenue and number of orders
+# per time bucket ('r:<bucket>', 'o:<bucket>') and times ordered per item
+# ('i:<item>', menu items only, the rest is counted together). Updated as
+# orders are placed, so nothing is computed from the guests' orders and the
+# size of a rollup depends on neither the party size nor the free-text orders.
+rollups = {}
+lock = threading.Lock()
+
+
+def replicated():
+    return getattr(store, 'replicated', False)
+
+
+def item_field(index, name):
+    '''Returns the counter of the menu item with that name.'''
+    position = index.find(name) if index else None
+    if position is None:
+        return OTHER_ITEM
+    return 'i:' + index.items[position].item[:NAME_LIMIT]
+
+
+def order_increments(party, item, cost, now):
+    bucket = int(now // BUCKET_SECONDS)
+    increments = {f'r:{bucket}': cost, f'o:{bucket}': 1}
+    index = menu.get_index(party)
+    for name in re.split(r'[,;\n]+', item):
+        if name.strip():
+            field = item_field(index, name)
+            increments[field] = increments.get(field, 0) + 1
+    return increments
+
+
+def load(party):
+    '''Reads the rollup of a party persisted by the previous run.'''
+    if store and not replicated():
+        rollup = store.load_analytics(party['id'])
+        with lock:
+            rollups[party['id']] = rollup
+
+
+def record_order(party, item, cost, now=None):
+    increments = order_increments(party, item, cost,
+                                  time.time() if now is None else now)
+    if replicated():
+        store.increment_analytics(party['id'], increments)
+        return
+    with lock:
+        rollup = rollups.setdefault(party['id'], {})
+        for field, value in increments.items():
+            rollup[field] = rollup.get(field, 0) + value
+        values = {field: rollup[field] for field in increments}
+    # Written with the other changes, see RedisPersistence.update_analytics
+    if store:
+        store.update_analytics(party['id'], values)
+
+
+def get_rollup(party):
+    if replicated():
+        return store.load_analytics(party['id'])
+    with lock:
+        return dict(rollups.get(party['id'], {}))
+
+
+def forget(party):
+    '''Drops the rollup of an archived party and returns it.'''
+    rollup = get_rollup(party)
+    with lock:
+        rollups.pop(party['id'], None)
+    return rollup
+
+
+def format_analytics(party):
+    revenues, orders, items = {}, {}, {}
+    for field, value in get_rollup(party).items():
+        kind, _, key = field.partition(':')
+        if kind == 'r':
+            revenues[int(key)] = value
+        elif kind == 'o':
+            orders[int(key)] = value
+        elif kind == 'i':
+            items[key or 'не из меню'] = value
+    revenue, count = sum(revenues.values()), sum(orders.values())
+    text = f'Продажи вечеринки {party["date"]}: {revenue}руб., ' \
+           f'заказов: {count}'
+    if not count:
+        return text + '.'
+    text += f', средний заказ: {revenue // count}руб.\n'
+
+    last = max(revenues)
+    first = max(min(revenues), last - CHART_BUCKETS + 1)
+    peak = max(revenues.get(bucket, 0) for bucket in range(first, last + 1))
+    text += f'\nПо {BUCKET_SECONDS // 60} минут:\n'
+    for bucket in range(first, last + 1):
+        start = time.strftime('%H:%M',
+                              time.localtime(bucket * BUCKET_SECONDS))
+        value = revenues.get(bucket, 0)
+        bar = '▇' * round(BAR_WIDTH * value / peak) if peak else ''
+        text += f'{start} {bar} {value}руб. ({orders.get(bucket, 0)})\n'
+
+    top = heapq.nlargest(TOP_ITEMS, items.items(),
+                         key=lambda item: (item[1], item[0]))
+    text += '\nЧаще всего заказывают:\n'
+    text += ''.join(f'{place}. {name} - {times}\n'
+                    for place, (name, times) in enumerate(top, start=1))
+    return text
@@ -0,0 +1,105 @@
+'''Compares the persistence codec with the plain pickles used before it.
+
+Builds a realistic party snapshot (guests with orders, their user_data and
+conversation states) and measures encode/decode time and size for the whole
+state, as the single-key layout stores it, and per guest record, as the
+sharded layout does.
+
+    python benchmarks/codec_benchmark.py --guests 300 --orders 5
+'''
+import argparse
+import os
+import pickle
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from billing import BOOKING_ORDER, Guest, Order  # noqa: E402
+from codec import Codec  # noqa: E402
+
+
+ITEMS = ['Пиво светлое 0.5', 'Гренки с чесноком', 'Сидр грушевый',
+         'Бургер классический, картофель фри', 'Кола 0.3', 'Настойка вишневая',
+         'Крылышки BBQ 12шт', 'Чай черный с чабрецом']
+
+
+def make_snapshot(guests, orders):
+    random.seed(1)
+    party_guests = {}
+    user_data = {}
+    conversations = {}
+    for user_id in range(100_000, 100_000 + guests):
+        party_orders = [BOOKING_ORDER]
+        for _ in range(orders):
+            item = ', '.join(random.sample(ITEMS, random.randint(1, 3)))
+            party_orders.append(Order(item, random.randint(2, 40) * 50))
+        party_guests[user_id] = Guest(
+            (f'guest{user_id}', 'Гость', random.choice(['Иванов', None])),
+            party_orders, bill_sent=random.random() < 0.3)
+        user_data[user_id] = {'party_id': '1000', 'item': item,
+                              'cost': party_orders[-1].cost}
+        conversations[(user_id, user_id)] = 0
+    party = {'id': '1000', 'admin_chat_id': -1000, 'date': '09 Марта 2024г.',
+             'place': 'баре Freedom', 'status': 'in progress',
+             'guests': party_guests}
+    return {
+        'conversations': {'party_billing_conversation': conversations},
+        'user_data': user_data,
+        'chat_data': {},
+        'bot_data': {'parties': {'1000': party}},
+    }
+
+
+def measure(encode, decode, values, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        encoded = [encode(value) for value in values]
+    encode_seconds = (time.perf_counter() - started) / repeat
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for data in encoded:
+            decode(data)
+    decode_seconds = (time.perf_counter() - started) / repeat
+    return sum(len(data) for data in encoded), encode_seconds, decode_seconds
+
+
+def run(args):
+    snapshot = make_snapshot(args.guests, args.orders)
+    guests = list(snapshot['bot_data']['parties']['1000']['guests'].values())
+    formats = {
+        'pickle (before)': (pickle.dumps, pickle.loads),
+        'codec, no compression': (Codec(compress_threshold=None).encode,
+                                  Codec().decode),
+        'codec': (Codec().encode, Codec().decode),
+        'codec, zlib level 1': (Codec(compress_level=1).encode,
+                                Codec().decode),
+        'codec, zlib level 9': (Codec(compress_level=9).encode,
+                                Codec().decode),
+    }
+    print(f'Guests: {args.guests}, orders per guest: {args.orders}')
+    for title, values in (('Whole state (blob layout)', [snapshot]),
+                          ('Guest records (sharded layout)', guests)):
+        print(f'{title}:')
+        baseline = None
+        for name, (encode, decode) in formats.items():
+            size, encode_seconds, decode_seconds = measure(
+                encode, decode, values, args.repeat)
+            baseline = baseline or size
+            print(f'\t{name:<24} {size:>9} bytes ({size / baseline:4.0%}) '
+                  f'encode {encode_seconds * 1000:7.2f}ms '
+                  f'decode {decode_seconds * 1000:7.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guests', type=int, default=300)
+    parser.add_argument('--orders', type=int, default=5,
+                        help='orders per guest')
+    parser.add_argument('--repeat', type=int, default=20)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
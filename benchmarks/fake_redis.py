@@ -0,0 +1,154 @@
+import threading
+
+from redis.exceptions import ConnectionError
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakeRedis:
+    '''In-memory stand-in for the part of redis.Redis used by the bot.
+
+    Counts commands and bytes written so benchmarks can report Redis traffic.
+    While `available` is False pings and pipelines fail like a stopped Redis.
+    '''
+
+    def __init__(self):
+        self.available = True
+        self.data = {}
+        self.lock = threading.RLock()
+        self.commands = 0
+        self.bytes_written = 0
+
+    def _written(self, *values):
+        self.bytes_written += sum(len(to_bytes(value)) for value in values)
+
+    def ping(self):
+        if not self.available:
+            raise ConnectionError('Fake Redis is stopped')
+        return True
+
+    def get(self, name):
+        with self.lock:
+            self.commands += 1
+            return self.data.get(to_bytes(name))
+
+    def set(self, name, value):
+        with self.lock:
+            self.commands += 1
+            self._written(value)
+            self.data[to_bytes(name)] = to_bytes(value)
+            return True
+
+    def exists(self, *names):
+        with self.lock:
+            self.commands += 1
+            return sum(to_bytes(name) in self.data for name in names)
+
+    def delete(self, *names):
+        with self.lock:
+            self.commands += 1
+            return sum(self.data.pop(to_bytes(name), None) is not None
+                       for name in names)
+
+    def rename(self, src, dst):
+        with self.lock:
+            self.commands += 1
+            self.data[to_bytes(dst)] = self.data.pop(to_bytes(src))
+            return True
+
+    def keys(self, pattern='*'):
+        with self.lock:
+            self.commands += 1
+            return list(self.data)
+
+    def hget(self, name, key):
+        with self.lock:
+            self.commands += 1
+            return self.data.get(to_bytes(name), {}).get(to_bytes(key))
+
+    def hset(self, name, key, value):
+        with self.lock:
+            self.commands += 1
+            self._written(value)
+            hash_ = self.data.setdefault(to_bytes(name), {})
+            new = to_bytes(key) not in hash_
+            hash_[to_bytes(key)] = to_bytes(value)
+            return int(new)
+
+    def hmset(self, name, mapping):
+        with self.lock:
+            self.commands += 1
+            self._written(*mapping.values())
+            hash_ = self.data.setdefault(to_bytes(name), {})
+            for key, value in mapping.items():
+                hash_[to_bytes(key)] = to_bytes(value)
+            return True
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            self.commands += 1
+            hash_ = self.data.get(to_bytes(name), {})
+            return sum(hash_.pop(to_bytes(key), None) is not None
+                       for key in keys)
+
+    def hgetall(self, name):
+        with self.lock:
+            self.commands += 1
+            return dict(self.data.get(to_bytes(name), {}))
+
+    def hkeys(self, name):
+        with self.lock:
+            self.commands += 1
+            return list(self.data.get(to_bytes(name), {}))
+
+    def sadd(self, name, *values):
+        with self.lock:
+            self.commands += 1
+            self._written(*values)
+            set_ = self.data.setdefault(to_bytes(name), set())
+            added = {to_bytes(value) for value in values} - set_
+            set_ |= added
+            return len(added)
+
+    def smembers(self, name):
+        with self.lock:
+            self.commands += 1
+            return set(self.data.get(to_bytes(name), set()))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        if not self.redis.available:
+            self.calls = []
+            raise ConnectionError('Fake Redis is stopped')
+        with self.redis.lock:
+            results = [method(*args, **kwargs)
+                       for method, args, kwargs in self.calls]
+        self.calls = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.calls = []
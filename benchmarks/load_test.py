@@ -0,0 +1,320 @@
+'''Offline load test that simulates a whole party against the real handlers.
+
+Hundreds of synthetic guests go through /start -> item -> cost -> "Да" with
+their updates interleaved the way they arrive at the bar. Telegram is replaced
+by a bot that records outgoing calls and Redis by an in-memory stand-in, so
+the numbers show the cost of the bot itself.
+
+    python benchmarks/load_test.py --guests 300 --orders 3
+
+With --journal the persistence keeps a local journal, and --outage stops
+the in-memory Redis for the middle order rounds to check that no change is
+lost once it is back. --digest-max-orders batches the orders sent to the
+admin chat into digests.
+'''
+import argparse
+import datetime
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+import time
+from queue import Queue
+
+from telegram import (CallbackQuery, Chat, Message, MessageEntity, Update,
+                      User)
+from telegram.ext import Dispatcher, JobQueue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_redis import FakeRedis  # noqa: E402
+
+
+ADMIN_CHAT_ID = -1000
+ADMIN_USER_ID = 1
+
+
+def load_bot_module():
+    spec = importlib.util.spec_from_file_location(
+        'party_billing_bot', os.path.join(ROOT, 'party-billing-bot.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['party_billing_bot'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeBot:
+    '''Records outgoing Bot API calls instead of sending them.'''
+
+    def __init__(self, latency=0):
+        self.calls = []
+        self.latency = latency
+        self.message_id = 0
+        self.bot = User(0, 'PartyBillingBot', is_bot=True,
+                        username='party_billing_bot')
+        self.username = self.bot.username
+        self.id = self.bot.id
+        self.defaults = None
+
+    def _message(self, chat_id, text=None):
+        time.sleep(self.latency)
+        self.message_id += 1
+        return Message(self.message_id, datetime.datetime.now(),
+                       Chat(chat_id, Chat.PRIVATE), text=text, bot=self)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(('send_message', chat_id, len(text)))
+        return self._message(chat_id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None,
+                          inline_message_id=None, **kwargs):
+        self.calls.append(('edit_message_text', chat_id, len(text)))
+        return self._message(chat_id, text)
+
+    def forward_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.calls.append(('forward_message', chat_id, 0))
+        return self._message(chat_id)
+
+    def send_document(self, chat_id, document, **kwargs):
+        self.calls.append(('send_document', chat_id, 0))
+        return self._message(chat_id)
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        time.sleep(self.latency)
+        self.calls.append(('answer_callback_query', None, 0))
+        return True
+
+    def get_me(self):
+        return self.bot
+
+
+class UpdateFactory:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def message(self, user_id, chat_id, text):
+        self.update_id += 1
+        user = User(user_id, f'Гость{user_id}', is_bot=False,
+                    last_name='Тестовый', username=f'guest{user_id}')
+        chat_type = Chat.PRIVATE if chat_id > 0 else Chat.SUPERGROUP
+        entities = []
+        if text.startswith('/'):
+            entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0,
+                                      len(text.split()[0]))]
+        message = Message(self.update_id, datetime.datetime.now(),
+                          Chat(chat_id, chat_type), from_user=user,
+                          text=text, entities=entities, bot=self.bot)
+        return Update(self.update_id, message=message)
+
+    def callback(self, user_id, chat_id, data):
+        self.update_id += 1
+        user = User(user_id, 'Админ', is_bot=False)
+        message = Message(self.update_id, datetime.datetime.now(),
+                          Chat(chat_id, Chat.SUPERGROUP), text='',
+                          bot=self.bot)
+        query = CallbackQuery(str(self.update_id), user, 'instance',
+                              message=message, data=data, bot=self.bot)
+        return Update(self.update_id, callback_query=query)
+
+
+def wait_idle(dispatcher):
+    while dispatcher.update_queue.qsize() or dispatcher.chat_queues:
+        time.sleep(0.01)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(args):
+    bot_module = load_bot_module()
+    redis_storage = FakeRedis()
+    journal = None
+    if args.journal or args.outage:
+        journal = bot_module.Journal(
+            args.journal or os.path.join(tempfile.mkdtemp(), 'journal'))
+    persistence = bot_module.create_persistence(
+        redis_storage, args.layout, args.flush_interval, journal=journal)
+    persistence.retry_interval = 0.1
+    bot = FakeBot(args.api_latency / 1000)
+    job_queue = JobQueue()
+    if args.concurrency:
+        dispatcher = bot_module.ChatOrderedDispatcher(
+            bot, Queue(), job_queue=job_queue, persistence=persistence,
+            concurrency=args.concurrency)
+        threading.Thread(target=dispatcher.start, daemon=True).start()
+    else:
+        dispatcher = Dispatcher(bot, Queue(), job_queue=job_queue,
+                                persistence=persistence)
+    job_queue.set_dispatcher(dispatcher)
+    if persistence.write_behind:
+        persistence.start_write_behind(job_queue)
+    evictor = bot_module.setup_dispatcher(
+        dispatcher, [ADMIN_CHAT_ID], max_idle_users=args.max_idle_users,
+        digest_window=args.digest_window,
+        digest_max_orders=args.digest_max_orders)
+    factory = UpdateFactory(bot)
+
+    latencies = {}
+    last_flush = time.perf_counter()
+
+    def process(step, update):
+        nonlocal last_flush
+        if args.concurrency:
+            # Handled by the chat workers, see the handler.* histograms
+            dispatcher.update_queue.put(update)
+            return
+        start = time.perf_counter()
+        dispatcher.process_update(update)
+        finished = time.perf_counter()
+        latencies.setdefault(step, []).append(finished - start)
+        # The job queue isn't running, flush like its repeating job would
+        if persistence.write_behind \
+                and finished - last_flush >= persistence.flush_interval:
+            persistence.flush_dirty()
+            last_flush = time.perf_counter()
+
+    guests = range(100_000, 100_000 + args.guests)
+    started = time.perf_counter()
+    for user_id in guests:
+        process('start', factory.message(user_id, user_id, '/start'))
+    for order in range(args.orders):
+        # Redis is stopped for the middle rounds
+        redis_storage.available = not args.outage \
+            or order not in range(1, args.orders - 1)
+        for user_id in guests:
+            process('get_item', factory.message(
+                user_id, user_id, f'Пиво светлое 0.5, гренки #{order}'))
+        for user_id in guests:
+            process('get_cost', factory.message(user_id, user_id, '450'))
+        for user_id in guests:
+            process('confirm_choice', factory.message(user_id, user_id, 'Да'))
+    if args.concurrency:
+        wait_idle(dispatcher)
+    persistence.flush_dirty()
+    elapsed = time.perf_counter() - started
+    # The job queue isn't running, send what the window would have
+    bot_module.digests.order_digest.flush_all(bot)
+    digest_messages = sum(1 for name, chat_id, _ in bot.calls
+                          if name == 'send_message'
+                          and chat_id == ADMIN_CHAT_ID)
+    while persistence.stats['offline']:
+        time.sleep(0.01)
+    if evictor:
+        # Run by the job queue every minute in the bot
+        evictor.evict_idle()
+        counters = bot_module.metrics.counters
+        print(f'Evicted: {counters.get("evicted.users", 0)} users, '
+              f'{counters.get("evicted.conversations", 0)} conversations, '
+              f'{counters.get("evicted.user_data", 0)} user_data; '
+              f'{len(dispatcher.user_data)} user_data left')
+    guest_updates = args.guests * (1 + 3 * args.orders)
+
+    admin_messages = {}
+    process('adm_help', factory.message(ADMIN_USER_ID, ADMIN_CHAT_ID, 'hi'))
+    if args.concurrency:
+        wait_idle(dispatcher)
+    for command in args.admin_commands:
+        calls_before = len(bot.calls)
+        if command.startswith('/'):
+            update = factory.message(ADMIN_USER_ID, ADMIN_CHAT_ID, command)
+        else:
+            update = factory.callback(ADMIN_USER_ID, ADMIN_CHAT_ID, command)
+        process(command, update)
+        if args.concurrency:
+            wait_idle(dispatcher)
+        admin_messages[command] = len(bot.calls) - calls_before
+    persistence.flush()
+
+    orders = args.guests * args.orders
+    print(f'Guests: {args.guests}, orders: {orders}, '
+          f'layout: {args.layout}, '
+          f'write-behind: {persistence.write_behind}')
+    print(f'Guest updates: {guest_updates} in {elapsed:.2f}s, '
+          f'{guest_updates / elapsed:.0f} updates/s')
+    print(f'Admin chat messages for the orders: {digest_messages}')
+    if args.concurrency:
+        dispatcher.stop()
+        wait = dispatcher.queue_wait
+        print(f'Concurrency: {args.concurrency}, queue wait: '
+              f'p50≤{wait.percentile(0.5) * 1000:.0f}ms '
+              f'p99≤{wait.percentile(0.99) * 1000:.0f}ms '
+              f'max={wait.max * 1000:.0f}ms')
+        print('Handler latency, ms:')
+        for name, histogram in sorted(bot_module.metrics.histograms.items()):
+            if name.startswith('handler.') and histogram.count:
+                print(f'\t{name[8:]:<20} n={histogram.count:<6} '
+                      f'p50≤{histogram.percentile(0.5) * 1000:7.2f} '
+                      f'p99≤{histogram.percentile(0.99) * 1000:7.2f} '
+                      f'max={histogram.max * 1000:7.2f}')
+    else:
+        print('Handler latency, ms:')
+        for step, samples in latencies.items():
+            print(f'\t{step:<20} n={len(samples):<6} '
+                  f'p50={percentile(samples, 0.5) * 1000:7.2f} '
+                  f'p99={percentile(samples, 0.99) * 1000:7.2f} '
+                  f'max={max(samples) * 1000:7.2f}')
+    stats = persistence.stats
+    ledger = bot_module.parties.get_admin_party(
+        dispatcher.bot_data, ADMIN_CHAT_ID)['ledger']
+    print(f'Ledger total: {ledger["total"]}руб.')
+    print(f'Persistence: {stats["bytes_written"]} bytes in '
+          f'{stats["flushes"]} flushes, '
+          f'{stats["bytes_written"] / orders:.0f} bytes per order, '
+          f'{redis_storage.commands} Redis commands')
+    print('Outgoing messages per admin command:')
+    for command, count in admin_messages.items():
+        print(f'\t{command:<20} {count}')
+    if journal:
+        print(f'Journal: {journal.stats["appended"]} records, '
+              f'{journal.stats["fsyncs"]} fsyncs, '
+              f'{journal.stats["compactions"]} compactions, '
+              f'{stats["replayed_records"]} replayed')
+        journal.close()
+        # The state a restarted bot would load from Redis
+        reloaded = bot_module.create_persistence(redis_storage, args.layout)
+        party = bot_module.parties.get_admin_party(
+            reloaded.get_bot_data(), ADMIN_CHAT_ID)
+        bot_module.billing.rebuild_ledger(party)
+        print(f'Ledger total in Redis: {party["ledger"]["total"]}руб.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guests', type=int, default=300)
+    parser.add_argument('--orders', type=int, default=3,
+                        help='orders per guest')
+    parser.add_argument('--layout', choices=['sharded', 'blob'],
+                        default='sharded')
+    parser.add_argument('--flush-interval', type=float, default=0,
+                        help='enables write-behind persistence')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='handles chats in parallel on that many '
+                             'threads, 0 handles updates one by one')
+    parser.add_argument('--api-latency', type=float, default=0,
+                        help='simulated Bot API round-trip, ms')
+    parser.add_argument('--journal',
+                        help='journal file, a temporary one with --outage')
+    parser.add_argument('--outage', action='store_true',
+                        help='stops Redis for the middle order rounds')
+    parser.add_argument('--max-idle-users', type=int, default=0,
+                        help='evicts the least recently active users '
+                             'beyond that number after the orders')
+    parser.add_argument('--digest-window', type=float, default=0,
+                        help='seconds the orders wait for a digest')
+    parser.add_argument('--digest-max-orders', type=int, default=0,
+                        help='orders sent as one digest at most')
+    parser.add_argument('--admin-commands', nargs='*',
+                        default=['/total', 'report:total:1', '/debtors',
+                                 '/sendbills', '/analytics', '/stats'])
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+'''Checks payment receipts offline the way the bot does for guests.
+
+Generates sample bank receipts (PDF with the paid sum, some of them with a
+wrong sum, without one or as a picture), or takes real ones with the sum
+they are expected to match, and runs them through the receipt matcher with
+a bot that serves the files from memory. Prints the throughput and the
+share of receipts matched without an admin.
+
+    python benchmarks/receipts_benchmark.py --receipts 500 --workers 4
+    python benchmarks/receipts_benchmark.py --file receipt.pdf:1250
+'''
+import argparse
+import datetime
+import io
+import os
+import random
+import sys
+import time
+
+from telegram import Chat, Document, Message
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import metrics  # noqa: E402
+import receipts  # noqa: E402
+from billing import Guest, Order  # noqa: E402
+from load_test import FakeBot  # noqa: E402
+
+
+ADMIN_CHAT_ID = -1000
+
+
+def make_pdf(lines):
+    '''Returns a one-page PDF with the lines, text extractable as in the
+    receipts of bank apps thanks to a ToUnicode map of the font.'''
+    chars = sorted({char for line in lines for char in line
+                    if ord(char) > 126})
+    codes = {char: 128 + index for index, char in enumerate(chars)}
+
+    def encode(line):
+        return ''.join(f'\\{codes[char]:03o}' if char in codes
+                       else '\\' + char if char in '()\\' else char
+                       for char in line)
+
+    content = 'BT /F1 12 Tf 50 780 Td 16 TL\n' \
+        + '\n'.join(f"({encode(line)}) '" for line in lines) + '\nET'
+    mappings = [f'<{codes[char]:02X}> <{ord(char):04X}>' for char in chars]
+    cmap = '/CIDInit /ProcSet findresource begin 12 dict begin begincmap\n' \
+           '/CMapName /Receipt def /CMapType 2 def\n' \
+           '1 begincodespacerange <00> <FF> endcodespacerange\n'
+    for start in range(0, len(mappings), 100):
+        chunk = mappings[start:start + 100]
+        cmap += f'{len(chunk)} beginbfchar\n' + '\n'.join(chunk) \
+            + '\nendbfchar\n'
+    cmap += 'endcmap CMapName currentdict /CMap defineresource pop end end'
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+        '/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>',
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+        '/ToUnicode 6 0 R >>',
+        f'<< /Length {len(content)} >>\nstream\n{content}\nendstream',
+        f'<< /Length {len(cmap)} >>\nstream\n{cmap}\nendstream',
+    ]
+    pdf = io.BytesIO()
+    pdf.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(pdf.tell())
+        pdf.write(f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1'))
+    xref = pdf.tell()
+    pdf.write(f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode())
+    for offset in offsets:
+        pdf.write(f'{offset:010d} 00000 n \n'.encode())
+    pdf.write(f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n'
+              f'startxref\n{xref}\n%%EOF\n'.encode())
+    return pdf.getvalue()
+
+
+def format_sum(amount):
+    return f'{amount:,}'.replace(',', ' ') + ',00 ₽'
+
+
+def make_receipt(subtotal, kind):
+    '''Returns the file and its mime type.'''
+    lines = ['Чек по операции', '18.10.2026 23:41:07',
+             'Перевод по номеру телефона', 'Счет списания **** 4417']
+    if kind == 'picture':
+        return b'\xff\xd8\xff\xe0', 'image/jpeg'
+    if kind == 'matched':
+        lines.append(f'Итого {format_sum(subtotal)}')
+    elif kind == 'mismatched':
+        lines.append(f'Итого {format_sum(subtotal - 50)}')
+    lines += ['Комиссия 0 ₽', 'Номер документа 1000000018102026']
+    if kind == 'unreadable':
+        lines.remove('Комиссия 0 ₽')
+    return make_pdf(lines), 'application/pdf'
+
+
+class ReceiptFile:
+
+    def __init__(self, data):
+        self.data = data
+
+    def download_as_bytearray(self):
+        return bytearray(self.data)
+
+
+class ReceiptBot(FakeBot):
+    '''Serves the receipt files from memory.'''
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+        self.files = {}
+
+    def get_file(self, file_id, **kwargs):
+        time.sleep(self.latency)
+        return ReceiptFile(self.files[file_id])
+
+
+def run(args):
+    random.seed(1)
+    bot = ReceiptBot(args.api_latency / 1000)
+    party = {'id': '1000', 'admin_chat_id': ADMIN_CHAT_ID, 'guests': {}}
+    samples = []
+    for path, subtotal in (file.rsplit(':', 1) for file in args.file):
+        with open(path, 'rb') as file:
+            mime_type = 'application/pdf' if path.endswith('.pdf') \
+                else 'image/jpeg'
+            samples.append((file.read(), mime_type, int(subtotal), None))
+    for _ in range(args.receipts):
+        subtotal = random.randint(2, 80) * 50
+        kind = random.choices(
+            ['matched', 'mismatched', 'unreadable', 'picture'],
+            [0.75, 0.1, 0.05, 0.1])[0]
+        samples.append((*make_receipt(subtotal, kind), subtotal, kind))
+
+    expected = {}
+    messages = []
+    for user_id, (data, mime_type, subtotal, kind) in enumerate(
+            samples, start=100_000):
+        party['guests'][user_id] = Guest(
+            (f'guest{user_id}', 'Гость', None), [Order('Заказ', subtotal)])
+        file_id = f'file{user_id}'
+        bot.files[file_id] = data
+        document = Document(file_id, file_id, file_name='receipt',
+                            mime_type=mime_type, file_size=len(data))
+        messages.append((user_id, Message(
+            user_id, datetime.datetime.now(), Chat(user_id, Chat.PRIVATE),
+            document=document, bot=bot)))
+        expected[user_id] = kind
+
+    matcher = receipts.ReceiptMatcher(bot, args.workers)
+    started = time.perf_counter()
+    for user_id, message in messages:
+        matcher.submit(party, user_id, message)
+    matcher.shutdown()
+    elapsed = time.perf_counter() - started
+
+    print(f'Receipts: {len(samples)}, workers: {args.workers}, '
+          f'{len(samples) / elapsed:.0f} receipts/s')
+    for outcome in ('matched', 'mismatched', 'unreadable', 'skipped',
+                    'failed'):
+        count = metrics.counters.get(f'receipts.{outcome}', 0)
+        print(f'\t{outcome:<12} {count}')
+    check = metrics.histograms['receipts.check']
+    print(f'Check time: p50≤{check.percentile(0.5) * 1000:.0f}ms '
+          f'p99≤{check.percentile(0.99) * 1000:.0f}ms '
+          f'max={check.max * 1000:.0f}ms')
+    print(metrics.format_stats().strip().splitlines()[-1])
+    wrong = [user_id for user_id, kind in expected.items()
+             if kind and (kind == 'matched')
+             != party['guests'][user_id].bill_payd]
+    print(f'Wrongly matched sample receipts: {len(wrong)}')
+    admin_messages = sum(1 for _, chat_id, _ in bot.calls
+                         if chat_id == ADMIN_CHAT_ID)
+    print(f'Admin chat messages: {admin_messages}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--receipts', type=int, default=300,
+                        help='generated sample receipts')
+    parser.add_argument('--file', action='append', default=[],
+                        help='real receipt and the sum it has to match, '
+                             'path:sum')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--api-latency', type=float, default=0,
+                        help='simulated file download round-trip, ms')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+'''Fake Telegram for testing several webhook replicas against one Redis.
+
+Serves a stub Bot API the replicas talk to (TELEGRAM_API_URL) and posts
+synthetic updates to the replicas round-robin, like a load balancer would.
+Guests order concurrently while the admin marks bills paid, afterwards the
+guest records in Redis are checked for lost updates. Start the script first,
+it waits for the replicas to come up.
+
+    python benchmarks/webhook_sender.py --api-port 8081 \\
+        --replicas http://127.0.0.1:8001/telegram http://127.0.0.1:8002/telegram \\
+        --redis-url redis://:password@127.0.0.1:6379/0
+'''
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import redis
+import requests
+
+# Guest records are decoded as billing.Guest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import Codec  # noqa: E402
+
+ADMIN_CHAT_ID = -1000
+ADMIN_USER_ID = 1
+BOT_USER = {'id': 0, 'is_bot': True, 'first_name': 'PartyBillingBot',
+            'username': 'party_billing_bot'}
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    '''Answers every Bot API method with a plausible successful result.'''
+
+    message_ids = itertools.count(1)
+    calls = 0
+
+    def do_POST(self):
+        BotApiHandler.calls += 1
+        method = self.path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        params = json.loads(self.rfile.read(length) or b'{}') \
+            if 'json' in self.headers.get('Content-Type', '') else {}
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in ('sendMessage', 'editMessageText', 'forwardMessage',
+                        'sendDocument'):
+            chat_id = int(params.get('chat_id', ADMIN_CHAT_ID))
+            result = {'message_id': next(self.message_ids),
+                      'date': int(time.time()),
+                      'chat': {'id': chat_id,
+                               'type': 'private' if chat_id > 0
+                               else 'supergroup'},
+                      'text': params.get('text', '')}
+        else:
+            result = True
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Sender:
+
+    def __init__(self, replicas):
+        self.replicas = itertools.cycle(replicas)
+        self.lock = threading.Lock()
+        self.update_ids = itertools.count(1)
+        self.sent = 0
+
+    def post(self, update):
+        with self.lock:
+            replica = next(self.replicas)
+            update['update_id'] = next(self.update_ids)
+            self.sent += 1
+        requests.post(replica, json=update, timeout=10).raise_for_status()
+
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'Гость{user_id}',
+                'username': f'guest{user_id}'}
+
+    def message(self, user_id, chat_id, text):
+        message = {'message_id': random.randint(1, 10 ** 9),
+                   'date': int(time.time()),
+                   'chat': {'id': chat_id,
+                            'type': 'private' if chat_id > 0
+                            else 'supergroup'},
+                   'from': self.user(user_id),
+                   'text': text}
+        command = re.match(r'/\w+', text)
+        if command:
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': command.end()}]
+        self.post({'message': message})
+
+    def callback(self, data):
+        self.post({'callback_query': {
+            'id': str(random.randint(1, 10 ** 9)),
+            'from': self.user(ADMIN_USER_ID),
+            'chat_instance': 'admin',
+            'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()),
+                        'chat': {'id': ADMIN_CHAT_ID, 'type': 'supergroup'},
+                        'text': 'Счет не оплачен.'},
+        }})
+
+
+def run_guest(sender, user_id, orders, cost, delay):
+    sender.message(user_id, user_id, '/start')
+    for order in range(orders):
+        for text in (f'Заказ #{order}', str(cost), 'Да'):
+            time.sleep(delay)
+            sender.message(user_id, user_id, text)
+
+
+def wait_for(replicas, timeout):
+    deadline = time.monotonic() + timeout
+    for replica in replicas:
+        while True:
+            try:
+                requests.get(replica, timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+
+
+def run(args):
+    api = ThreadingHTTPServer(('127.0.0.1', args.api_port), BotApiHandler)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    print(f'Bot API stub on http://127.0.0.1:{args.api_port}/bot, '
+          f'waiting for {len(args.replicas)} replicas')
+    wait_for(args.replicas, args.startup_timeout)
+
+    sender = Sender(args.replicas)
+    sender.message(ADMIN_USER_ID, ADMIN_CHAT_ID, 'hi')
+    time.sleep(args.delay)
+    guests = list(range(100_000, 100_000 + args.guests))
+    paid = set(random.sample(guests, len(guests) // 2))
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for user_id in guests:
+            pool.submit(run_guest, sender, user_id, args.orders, args.cost,
+                        args.delay)
+        # "Mark paid" clicks race with the guests' orders
+        time.sleep(args.delay * 2)
+        for user_id in paid:
+            pool.submit(sender.callback, f'closebill:{user_id}:debtors:0')
+    elapsed = time.perf_counter() - started
+    print(f'Sent {sender.sent} updates in {elapsed:.1f}s, '
+          f'Bot API calls: {BotApiHandler.calls}')
+
+    time.sleep(args.settle)
+    storage = redis.Redis.from_url(args.redis_url)
+    # The first party of an admin chat is keyed by the chat id
+    records = storage.hgetall(
+        f'{args.prefix}:party:{abs(ADMIN_CHAT_ID)}:guests')
+    lost = 0
+    for user_id in guests:
+        raw = records.get(str(user_id).encode())
+        guest = Codec().decode(raw) if raw else None
+        expected_orders = 1 + args.orders
+        if guest is None or len(guest.orders) != expected_orders \
+                or guest.bill_payd != (user_id in paid):
+            lost += 1
+            print(f'Guest {user_id}: {guest}')
+    print(f'Guests checked: {len(guests)}, inconsistent: {lost}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--replicas', nargs='+', required=True,
+                        help='webhook URLs of the bot replicas')
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/0')
+    parser.add_argument('--prefix', default='TelegramBotPersistence')
+    parser.add_argument('--guests', type=int, default=50)
+    parser.add_argument('--orders', type=int, default=3)
+    parser.add_argument('--cost', type=int, default=450)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.3,
+                        help='pause between the steps of one guest')
+    parser.add_argument('--settle', type=float, default=3,
+                        help='time for the replicas to finish processing')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
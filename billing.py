@@ -0,0 +1,199 @@
+import threading
+
+
+class Order:
+    __slots__ = ('item', 'cost')
+
+    def __init__(self, item, cost):
+        self.item = item
+        self.cost = cost
+
+    def __iter__(self):
+        return iter((self.item, self.cost))
+
+    def __reduce__(self):
+        return Order, (self.item, self.cost)
+
+    def __repr__(self):
+        return f'Order({self.item!r}, {self.cost})'
+
+
+BOOKING_ORDER = Order('Бронирование', 300)
+
+class Guest:
+    '''Guest of a party with the orders and the state of the bill.
+
+    Pickled as the field values with the orders split into an items and a
+    costs column: without per-record key strings and per-order tuples the
+    records take less memory and space than the dicts used before. Those
+    are converted by `as_guest` when the ledger is rebuilt.
+    '''
+
+    __slots__ = ('name', 'orders', 'bill_sent', 'bill_payd', 'subtotal')
+
+    def __init__(self, name, orders=None, bill_sent=False, bill_payd=False):
+        self.name = name
+        self.orders = orders if orders is not None else []
+        self.bill_sent = bill_sent
+        self.bill_payd = bill_payd
+        self.subtotal = sum(order.cost for order in self.orders)
+
+    def __reduce__(self):
+        items = tuple(order.item for order in self.orders)
+        costs = tuple(order.cost for order in self.orders)
+        return restore_guest, (self.name, items, costs, self.bill_sent,
+                               self.bill_payd)
+
+    def __repr__(self):
+        return f'Guest(name={self.name!r}, orders={len(self.orders)}, ' \
+               f'subtotal={self.subtotal}, bill_sent={self.bill_sent}, ' \
+               f'bill_payd={self.bill_payd})'
+
+
+def restore_guest(name, items, costs, bill_sent, bill_payd):
+    return Guest(name, [Order(item, cost) for item, cost in zip(items, costs)],
+                 bill_sent, bill_payd)
+
+
+def as_guest(record):
+    '''Converts a guest dict persisted by older versions to a Guest.'''
+    if not isinstance(record, dict):
+        return record
+    return Guest(record['name'],
+                 [Order(item, cost) for item, cost in record['orders']],
+                 record['bill_sent'], record['bill_payd'])
+
+
+# Guards the guest records and the ledger, handlers of different chats run in
+# parallel and the broadcast job marks bills sent from its own thread. Also
+# held by the persistence while it applies guests changed by other replicas.
+lock = threading.RLock()
+
+# Set to the persistence when several replicas share Redis: guest changes are
+# then applied to the stored record atomically, see
+# ShardedRedisPersistence.update_guest
+shared_store = None
+# Otherwise called with the party id and user id of every changed guest, so
+# the persistence writes just that guest, see
+# ShardedRedisPersistence.mark_guest_changed
+changed_listener = None
+
+
+def rebuild_ledger(party):
+    '''Recomputes guest subtotals, the party total and the unpaid index from the orders.'''
+    with lock:
+        ledger = {'total': 0, 'unpaid_total': 0, 'unpaid': set()}
+        for user_id, guest in list(party['guests'].items()):
+            guest = party['guests'][user_id] = as_guest(guest)
+            guest.subtotal = sum(order.cost for order in guest.orders)
+            account(ledger, user_id, guest.subtotal, guest.bill_payd, 1)
+        party['ledger'] = ledger
+        return ledger
+
+
+def get_ledger(party):
+    if 'ledger' not in party:
+        return rebuild_ledger(party)
+    return party['ledger']
+
+
+def get_unpaid(party):
+    with lock:
+        return sorted(get_ledger(party)['unpaid'])
+
+
+def account(ledger, user_id, subtotal, paid, sign):
+    '''Adds (sign=1) or removes (sign=-1) the guest's amounts to the ledger.'''
+    ledger['total'] += sign * subtotal
+    if not paid:
+        ledger['unpaid_total'] += sign * subtotal
+        if sign > 0:
+            ledger['unpaid'].add(user_id)
+        else:
+            ledger['unpaid'].discard(user_id)
+
+
+def update_guest(party, user_id, mutate):
+    '''Applies `mutate` to the guest record and keeps the ledger in step.
+
+    `mutate` gets the current record (None for a new guest) and returns the
+    new one. With a shared store it may be called again on a fresher record.
+    '''
+    if shared_store:
+        # The round-trips to Redis are made without the lock, it is taken
+        # by the store only to apply the written record
+        return shared_store.update_guest(
+            party['id'], user_id, lambda current: mutate(as_guest(current)),
+            lambda guest: store_guest(party, user_id, guest))
+    with lock:
+        previous = party['guests'].get(user_id)
+        # Taken before `mutate`, which changes the record in place
+        previous_amounts = previous and (previous.subtotal, previous.bill_payd)
+        guest = mutate(previous)
+        store_guest(party, user_id, guest, previous_amounts)
+    if changed_listener:
+        changed_listener(party['id'], user_id)
+    return guest
+
+
+def store_guest(party, user_id, guest, previous_amounts=None):
+    '''Puts the new guest record in place of the one in the ledger.'''
+    with lock:
+        ledger = get_ledger(party)
+        previous = party['guests'].get(user_id)
+        if previous is not None:
+            account(ledger, user_id, *(previous_amounts or (
+                previous.subtotal, previous.bill_payd)), -1)
+        party['guests'][user_id] = guest
+        account(ledger, user_id, guest.subtotal, guest.bill_payd, 1)
+
+
+def replace_guests(bot_data, changes):
+    '''Stores guests changed by other replicas, {party_id: {user_id: record}}.'''
+    with lock:
+        for party_id, guests in changes.items():
+            party = bot_data.get('parties', {}).get(party_id)
+            if party is None:
+                continue
+            for user_id, guest in guests.items():
+                guest = as_guest(guest)
+                previous = party['guests'].get(user_id)
+                party['guests'][user_id] = guest
+                if 'ledger' not in party:
+                    continue
+                if previous is not None:
+                    account(party['ledger'], user_id, previous.subtotal,
+                            previous.bill_payd, -1)
+                account(party['ledger'], user_id, guest.subtotal,
+                        guest.bill_payd, 1)
+
+
+def add_guest(party, user_id, name):
+    def create(guest):
+        if guest is not None:
+            return guest
+        return Guest(name, [BOOKING_ORDER])
+    return update_guest(party, user_id, create)
+
+
+def add_order(party, user_id, item, cost):
+    def append(guest):
+        guest.orders.append(Order(item, cost))
+        guest.subtotal += cost
+        return guest
+    return update_guest(party, user_id, append)
+
+
+def mark_paid(party, user_id):
+    def pay(guest):
+        guest.bill_payd = True
+        return guest
+    return update_guest(party, user_id, pay)
+
+
+def mark_bill_sent(party, user_id):
+    def sent(guest):
+        guest.bill_sent = True
+        return guest
+    return update_guest(party, user_id, sent)
+
@@ -0,0 +1,182 @@
+import logging
+import time
+from threading import Lock
+
+from telegram.error import (BadRequest, NetworkError, RetryAfter,
+                            Unauthorized)
+
+import billing
+import reports
+
+
+logger = logging.getLogger(__file__)
+
+# Telegram allows about 30 messages per second overall and one message per
+# second to the same chat, group chats get about 20 messages per minute.
+GLOBAL_RATE = 25
+CHAT_INTERVAL = 1.0
+PROGRESS_INTERVAL = 5.0
+TICK_INTERVAL = 1.0
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 60
+
+
+class TokenBucket:
+    '''Allows up to `rate` acquisitions per second with bursts of `capacity`.'''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def try_acquire(self):
+        '''Takes a token and returns 0, or returns how long to wait for one.'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+global_bucket = TokenBucket(GLOBAL_RATE)
+chat_last_sent = {}
+
+
+def wait_for_chat(chat_id):
+    '''Returns how long to wait before the chat may receive a message.'''
+    elapsed = time.monotonic() - chat_last_sent.get(chat_id, 0)
+    return max(0, CHAT_INTERVAL - elapsed)
+
+
+def is_running(party):
+    state = party.get('broadcast')
+    return bool(state and state['queue'])
+
+
+def start_broadcast(bot, job_queue, party, user_ids, chat_id):
+    '''Queues bills of the given guests and posts a progress message.'''
+    message = bot.send_message(chat_id=chat_id,
+                               text='Рассылка счетов запускается...')
+    party['broadcast'] = {
+        'queue': list(user_ids),
+        'status': {user_id: 'pending' for user_id in user_ids},
+        'attempts': {},
+        'retry_at': {},
+        'paused_until': 0,
+        'progress': (chat_id, message.message_id),
+        'progress_updated': 0,
+    }
+    schedule(job_queue, party)
+
+
+def resume_broadcast(job_queue, party):
+    '''Continues an interrupted broadcast after a restart.'''
+    if is_running(party):
+        logger.info('Resume bills broadcast: '
+                    f'{len(party["broadcast"]["queue"])} left')
+        schedule(job_queue, party)
+
+
+def schedule(job_queue, party, delay=0):
+    job_queue.run_once(broadcast_tick, delay, context=party['id'],
+                       name=f'bills_broadcast:{party["id"]}')
+
+
+def broadcast_tick(context):
+    # The party may have been archived meanwhile
+    party = context.bot_data.get('parties', {}).get(context.job.context)
+    state = party and party.get('broadcast')
+    if not state or not state['queue']:
+        return
+    try:
+        if time.time() >= state['paused_until']:
+            send_batch(context, party, state)
+        update_progress(context, state, finished=not state['queue'])
+    finally:
+        if state['queue']:
+            schedule(context.job_queue, party,
+                     max(TICK_INTERVAL, state['paused_until'] - time.time()))
+
+
+def send_batch(context, party, state):
+    now = time.time()
+    for _ in range(len(state['queue'])):
+        user_id = state['queue'][0]
+        if state['retry_at'].get(user_id, 0) > now or wait_for_chat(user_id):
+            state['queue'].append(state['queue'].pop(0))
+            continue
+        if global_bucket.try_acquire():
+            break
+        state['queue'].pop(0)
+        if not deliver(context, party, state, user_id):
+            break
+
+
+def deliver(context, party, state, user_id):
+    '''Sends one bill. Returns False if the whole broadcast has to pause.'''
+    guest = party['guests'].get(user_id)
+    if guest is None or guest.bill_payd:
+        state['status'][user_id] = 'skipped'
+        return True
+    try:
+        context.bot.send_message(chat_id=user_id,
+                                 text=reports.format_user_bill(guest))
+    except RetryAfter as error:
+        state['queue'].insert(0, user_id)
+        state['paused_until'] = time.time() + error.retry_after
+        logger.warning(f'Bills broadcast paused for {error.retry_after}s')
+        return False
+    except (Unauthorized, BadRequest) as error:
+        state['status'][user_id] = 'failed'
+        logger.warning(f'Bill to {user_id} not delivered: {error}')
+        return True
+    except NetworkError as error:
+        attempts = state['attempts'].get(user_id, 0) + 1
+        state['attempts'][user_id] = attempts
+        if attempts >= MAX_ATTEMPTS:
+            state['status'][user_id] = 'failed'
+            logger.warning(f'Bill to {user_id} not delivered: {error}')
+        else:
+            backoff = min(2 ** attempts, MAX_BACKOFF)
+            state['retry_at'][user_id] = time.time() + backoff
+            state['queue'].append(user_id)
+        return True
+    chat_last_sent[user_id] = time.monotonic()
+    billing.mark_bill_sent(party, user_id)
+    state['status'][user_id] = 'sent'
+    return True
+
+
+def format_progress(state, finished):
+    statuses = list(state['status'].values())
+    sent = statuses.count('sent')
+    failed = statuses.count('failed')
+    skipped = statuses.count('skipped')
+    title = 'Рассылка счетов завершена' if finished else 'Рассылка счетов'
+    text = f'{title}: отправлено {sent} из {len(statuses)}.\n'
+    if failed:
+        text += f'Не доставлено: {failed}.\n'
+    if skipped:
+        text += f'Пропущено (уже оплачено): {skipped}.\n'
+    if state['paused_until'] > time.time():
+        text += 'Пауза из-за ограничений Telegram.\n'
+    return text
+
+
+def update_progress(context, state, finished=False):
+    now = time.time()
+    if not finished and now - state['progress_updated'] < PROGRESS_INTERVAL:
+        return
+    chat_id, message_id = state['progress']
+    state['progress_updated'] = now
+    try:
+        context.bot.edit_message_text(format_progress(state, finished),
+                                      chat_id=chat_id, message_id=message_id)
+    except (BadRequest, RetryAfter) as error:
+        logger.debug(f'Progress message not updated: {error}')
@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+import metrics
+
+
+logger = logging.getLogger(__file__)
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    '''Dispatcher that handles updates of different chats in parallel.
+
+    Updates are queued per chat and each chat's queue is drained by one task
+    of a pool of `concurrency` threads, so updates of one chat are handled in
+    the order they arrived while a slow handler only holds up its own chat.
+    Updates passed to `process_update` before `start` (or after `stop`) are
+    handled synchronously, as by the plain Dispatcher.
+    '''
+
+    def __init__(self, *args, concurrency=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.chat_executor = None
+        self.chat_queues = {}
+        self.chat_queues_lock = threading.Lock()
+        self.queue_wait = metrics.get_histogram('dispatcher.queue_wait')
+
+    def start(self, ready=None):
+        self.chat_executor = ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix='ChatWorker')
+        super().start(ready)
+
+    def stop(self):
+        super().stop()
+        if self.chat_executor:
+            # Lets the chat queues drain before the persistence is flushed
+            self.chat_executor.shutdown(wait=True)
+            self.chat_executor = None
+
+    @staticmethod
+    def ordering_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    def process_update(self, update):
+        if not self.chat_executor:
+            super().process_update(update)
+            return
+        key = self.ordering_key(update)
+        with self.chat_queues_lock:
+            queue = self.chat_queues.get(key)
+            if queue is not None:
+                queue.append((update, time.perf_counter()))
+                return
+            self.chat_queues[key] = deque([(update, time.perf_counter())])
+        self.chat_executor.submit(self.drain_chat, key)
+
+    def drain_chat(self, key):
+        while True:
+            with self.chat_queues_lock:
+                queue = self.chat_queues[key]
+                if not queue:
+                    del self.chat_queues[key]
+                    return
+                update, queued = queue.popleft()
+            self.queue_wait.observe(time.perf_counter() - queued)
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception('Failed to process update %r', update)
@@ -0,0 +1,65 @@
+import pickle
+import zlib
+
+
+FORMAT_VERSION = 1
+# Format version -> function upgrading a value decoded in that version to the
+# next one. Register a hook here together with a FORMAT_VERSION bump when the
+# shape of persisted values changes, e.g.
+#     MIGRATIONS[1] = lambda value: rename_fields(value)
+# Values written before the codec existed are plain pickles, version 0.
+MIGRATIONS = {}
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec:
+    '''Encodes persisted values as a 3 byte header and a pickle.
+
+    The header holds a magic byte, the format version of the value and
+    flags. Pickles larger than `compress_threshold` bytes are compressed with
+    zlib. Values of older format versions are passed through the
+    `migrations` hooks on decoding, plain pickles written before the header
+    was introduced are read as version 0.
+    '''
+
+    MAGIC = 0xB1  # Never the first byte of a pickle, which starts with 0x80
+    COMPRESSED = 0x01
+
+    def __init__(self, version=FORMAT_VERSION, compress_threshold=1024,
+                 compress_level=6, migrations=None):
+        self.version = version
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.migrations = MIGRATIONS if migrations is None else migrations
+
+    def encode(self, value):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        flags = 0
+        if self.compress_threshold is not None \
+                and len(payload) > self.compress_threshold:
+            payload = zlib.compress(payload, self.compress_level)
+            flags |= self.COMPRESSED
+        return bytes((self.MAGIC, self.version, flags)) + payload
+
+    def decode(self, data):
+        if data[0] != self.MAGIC:
+            return self.migrate(pickle.loads(data), 0)
+        version, flags = data[1], data[2]
+        if version > self.version:
+            raise CodecError(f'Value of format version {version} is newer '
+                             f'than the supported {self.version}')
+        payload = memoryview(data)[3:]
+        if flags & self.COMPRESSED:
+            payload = zlib.decompress(payload)
+        return self.migrate(pickle.loads(payload), version)
+
+    def migrate(self, value, version):
+        while version < self.version:
+            migration = self.migrations.get(version)
+            if migration is not None:
+                value = migration(value)
+            version += 1
+        return value
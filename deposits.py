@@ -0,0 +1,89 @@
+import billing
+
+
+# Percents of the deposit at which the admins are told how much is left
+ALERT_THRESHOLDS = (50, 80, 90, 100)
+
+alert_thresholds = ALERT_THRESHOLDS
+# Set to the persistence when several replicas share Redis: the amount
+# ordered is then counted by a Redis counter all of them check and add to in
+# one step, see ShardedRedisPersistence.reserve_deposit
+shared_store = None
+# Otherwise counted here per party id, under the ledger lock
+spent_amounts = {}
+
+
+def count_spent(party):
+    '''Returns the amount the guests ordered, the bookings aside.'''
+    with billing.lock:
+        return sum(order.cost for guest in party['guests'].values()
+                   for order in guest.orders
+                   if tuple(order) != tuple(billing.BOOKING_ORDER))
+
+
+def get_limit(party):
+    return party.get('deposit') or 0
+
+
+def get_spent(party):
+    if shared_store:
+        return shared_store.get_deposit_spent(party['id'])
+    with billing.lock:
+        if party['id'] not in spent_amounts:
+            spent_amounts[party['id']] = count_spent(party)
+        return spent_amounts[party['id']]
+
+
+def get_remaining(party):
+    '''Returns what is left of the deposit, None if there is no deposit.'''
+    limit = get_limit(party)
+    if not limit:
+        return None
+    return max(limit - get_spent(party), 0)
+
+
+def reserve(party, amount):
+    '''Adds the order amount to the amount ordered if it fits the deposit.
+
+    Returns whether it fits and the amount ordered with it if it does, as
+    it is otherwise. Orders are counted with no deposit too, so a deposit
+    set later starts from what was ordered.
+    '''
+    limit = get_limit(party)
+    if shared_store:
+        return shared_store.reserve_deposit(party['id'], amount, limit or -1)
+    with billing.lock:
+        spent = get_spent(party)
+        if limit and spent + amount > limit:
+            return False, spent
+        spent_amounts[party['id']] = spent + amount
+        return True, spent + amount
+
+
+def release(party, amount):
+    '''Returns the amount of an order that was not placed.'''
+    if shared_store:
+        shared_store.release_deposit(party['id'], amount)
+        return
+    with billing.lock:
+        spent_amounts[party['id']] = get_spent(party) - amount
+
+
+def crossed_thresholds(party, amount, spent):
+    '''Returns the alert thresholds reached by the order of that amount.'''
+    limit = get_limit(party)
+    if not limit:
+        return []
+    return [threshold for threshold in alert_thresholds
+            if (spent - amount) * 100 < threshold * limit <= spent * 100]
+
+
+def seed(party):
+    '''Starts the shared counter of a party from the orders it has.'''
+    if shared_store:
+        shared_store.seed_deposit(party['id'], count_spent(party))
+
+
+def forget(party_id):
+    with billing.lock:
+        spent_amounts.pop(party_id, None)
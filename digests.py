@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+import metrics
+
+
+logger = logging.getLogger(__file__)
+
+MESSAGE_LIMIT = 4000
+MAX_GUESTS = 20
+RETRY_INTERVAL = 5
+PENDING_MARK = '🔔'
+DONE_MARK = '✅'
+
+# Set up with the dispatcher
+order_digest = None
+
+
+class OrderDigest:
+    '''Sends the confirmed orders to the admin chats as digest messages.
+
+    Orders are buffered per chat and sent grouped by guest, one message per
+    `window` seconds, or right away once `max_orders` are waiting. The flush
+    is scheduled when the first order of a digest arrives, so no order waits
+    longer than `window`, however steady the flow is. With a zero window every
+    order is sent as it comes.
+    '''
+
+    def __init__(self, job_queue, window=0, max_orders=0):
+        self.job_queue = job_queue
+        self.window = window
+        self.max_orders = max_orders
+        # chat id -> [(arrival time, user id, guest name, item, cost)]
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add_order(self, bot, chat_id, user_id, name, item, cost):
+        with self.lock:
+            orders = self.pending.setdefault(chat_id, [])
+            orders.append((time.monotonic(), user_id, name, item, cost))
+            count = len(orders)
+        if self.window <= 0 or self.max_orders and count >= self.max_orders:
+            self.flush(bot, chat_id)
+        elif count == 1:
+            self.schedule(chat_id, self.window)
+
+    def schedule(self, chat_id, delay):
+        self.job_queue.run_once(self.flush_job, delay, context=chat_id,
+                                name=f'order_digest:{chat_id}')
+
+    def flush_job(self, context):
+        self.flush(context.bot, context.job.context)
+
+    def flush(self, bot, chat_id):
+        with self.lock:
+            orders = self.pending.pop(chat_id, None)
+        if not orders:
+            return
+        for guests in split_guests(group_orders(orders)):
+            try:
+                bot.send_message(chat_id=chat_id,
+                                 text=format_digest(guests),
+                                 reply_markup=build_keyboard(guests))
+            except (Unauthorized, BadRequest) as error:
+                logger.warning(f'Order digest to {chat_id} not delivered: '
+                               f'{error}')
+            except (RetryAfter, NetworkError) as error:
+                # Sent later together with the orders arrived meanwhile
+                delay = getattr(error, 'retry_after', RETRY_INTERVAL)
+                logger.warning(f'Order digest delayed for {delay}s: {error}')
+                self.requeue(chat_id, orders, delay)
+                return
+            else:
+                self.observe(guests)
+            sent = {user_id for user_id, _, _ in guests}
+            orders = [order for order in orders if order[1] not in sent]
+
+    def observe(self, guests):
+        metrics.increment('digest.messages')
+        metrics.increment('digest.orders',
+                          sum(len(items) for _, _, items in guests))
+        delays = metrics.get_histogram('digest.delay')
+        now = time.monotonic()
+        for _, _, items in guests:
+            for arrived, *_ in items:
+                delays.observe(now - arrived)
+
+    def requeue(self, chat_id, orders, delay):
+        with self.lock:
+            current = self.pending.setdefault(chat_id, [])
+            current[:0] = orders
+            if len(current) == len(orders):
+                self.schedule(chat_id, delay)
+
+    def flush_all(self, bot):
+        '''Sends the buffered orders of every chat, used on shutdown.'''
+        for chat_id in list(self.pending):
+            self.flush(bot, chat_id)
+
+
+def group_orders(orders):
+    '''Returns (user id, name, orders) per guest in the order of arrival.'''
+    guests = {}
+    for order in orders:
+        _, user_id, name, _, _ = order
+        guests.setdefault(user_id, (user_id, name, []))[2].append(order)
+    return list(guests.values())
+
+
+def format_guest(name, items, mark=PENDING_MARK):
+    lines = [f'{mark} {name}:']
+    # Blank lines separate the guests, see mark_done
+    lines.extend(f'{" ".join(item.split())} - {cost}руб.'
+                 for _, _, _, item, cost in items)
+    return '\n'.join(lines)
+
+
+def split_guests(guests):
+    '''Splits the guests into digests fitting a message and its keyboard.'''
+    chunk, length = [], 0
+    for guest in guests:
+        guest_length = len(format_guest(guest[1], guest[2])) + 2
+        if chunk and (len(chunk) >= MAX_GUESTS
+                      or length + guest_length > MESSAGE_LIMIT):
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(guest)
+        length += guest_length
+    if chunk:
+        yield chunk
+
+
+def format_digest(guests):
+    count = sum(len(items) for _, _, items in guests)
+    blocks = [f'Новые заказы: {count}']
+    blocks.extend(format_guest(name, items)[:MESSAGE_LIMIT]
+                  for _, name, items in guests)
+    return '\n\n'.join(blocks)
+
+
+def build_keyboard(guests):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f'{DONE_MARK} {name}'[:64],
+                              callback_data=f'digest_done:{position}')]
+        for position, (_, name, _) in enumerate(guests, start=1)
+    ])
+
+
+def mark_done(message, position):
+    '''Returns the text and keyboard of a digest with a guest served.'''
+    blocks = message.text.split('\n\n')
+    if position < len(blocks) and blocks[position].startswith(PENDING_MARK):
+        blocks[position] = DONE_MARK + blocks[position][len(PENDING_MARK):]
+    keyboard = [
+        row for row in (message.reply_markup.inline_keyboard
+                        if message.reply_markup else [])
+        if row[0].callback_data != f'digest_done:{position}'
+    ]
+    return '\n\n'.join(blocks), InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import metrics
+
+
+logger = logging.getLogger(__file__)
+
+# user_data values kept only between the steps of one order
+SCRATCH_KEYS = ('item', 'cost')
+EVICTION_INTERVAL = 60
+
+
+class Evictor:
+    '''Forgets the conversation states and scratch user_data of idle users.
+
+    Users are evicted once idle for `ttl` seconds and, least recently active
+    first, when more than `max_users` are known. Their entries are removed
+    from memory and from the persistence, so a returning user starts over
+    from the entry points. With replicated persistence only the local copies
+    are dropped: other replicas may be talking to the user.
+    '''
+
+    def __init__(self, dispatcher, conversations, ttl=None, max_users=None):
+        self.dispatcher = dispatcher
+        self.conversations = conversations
+        self.ttl = ttl
+        self.max_users = max_users
+        # user id -> [last activity, ids of the chats of the user]
+        self.activity = OrderedDict()
+        self.lock = threading.Lock()
+        # Users of the loaded state count as active since the start
+        now = time.monotonic()
+        for handler in conversations:
+            if handler.persistent and self.replicated:
+                continue
+            for chat_id, user_id in list(handler.conversations):
+                self.activity.setdefault(user_id, [now, set()])[1].add(chat_id)
+        for user_id in list(dispatcher.user_data):
+            self.activity.setdefault(user_id, [now, set()])
+
+    @property
+    def replicated(self):
+        return getattr(self.dispatcher.persistence, 'replicated', False)
+
+    def touch(self, update, context):
+        if not update.effective_user:
+            return
+        user_id = update.effective_user.id
+        with self.lock:
+            entry = self.activity.pop(user_id, None) or [0, set()]
+            entry[0] = time.monotonic()
+            if update.effective_chat:
+                entry[1].add(update.effective_chat.id)
+            self.activity[user_id] = entry
+
+    def evict_idle(self, context=None):
+        now = time.monotonic()
+        with self.lock:
+            candidates = []
+            excess = len(self.activity) - (self.max_users
+                                           or len(self.activity))
+            for user_id, (last_seen, _) in self.activity.items():
+                if len(candidates) < excess:
+                    candidates.append(user_id)
+                elif self.ttl is not None and now - last_seen >= self.ttl:
+                    candidates.append(user_id)
+                else:
+                    break
+        evicted = 0
+        for user_id in candidates:
+            # Under the lock a user can't come back in the middle of it:
+            # touch runs before the conversation looks up the state
+            with self.lock:
+                entry = self.activity.get(user_id)
+                if entry is None or entry[0] > now:
+                    continue
+                del self.activity[user_id]
+                self.evict_user(user_id, entry[1])
+            evicted += 1
+        if evicted:
+            metrics.increment('evicted.users', evicted)
+            logger.info(f'Evicted {evicted} idle users')
+
+    def evict_user(self, user_id, chat_ids):
+        persistence = self.dispatcher.persistence
+        keys = [(chat_id, user_id) for chat_id in chat_ids]
+        if self.replicated:
+            persistence.forget_user(user_id, keys)
+            self.dispatcher.user_data.pop(user_id, None)
+            return
+        for handler in self.conversations:
+            with handler._conversations_lock:
+                for key in keys:
+                    if handler.conversations.pop(key, None) is None:
+                        continue
+                    if handler.persistent and persistence:
+                        persistence.update_conversation(handler.name, key,
+                                                        None)
+                    metrics.increment('evicted.conversations')
+        user_data = self.dispatcher.user_data.get(user_id)
+        if user_data is None:
+            return
+        kept = {key: value for key, value in user_data.items()
+                if key not in SCRATCH_KEYS}
+        if kept.get('party_id') not in self.dispatcher.bot_data.get(
+                'parties', {}):
+            kept.pop('party_id', None)
+        if kept == user_data:
+            return
+        metrics.increment('evicted.user_data')
+        if kept:
+            user_data.clear()
+            user_data.update(kept)
+            if persistence:
+                persistence.update_user_data(user_id, user_data)
+        else:
+            del self.dispatcher.user_data[user_id]
+            if persistence:
+                persistence.drop_user_data(user_id)
+
+
+def schedule(dispatcher, conversations, ttl=None, max_users=None,
+             interval=EVICTION_INTERVAL):
+    evictor = Evictor(dispatcher, conversations, ttl, max_users)
+    dispatcher.add_handler(TypeHandler(Update, evictor.touch), group=-1)
+    dispatcher.job_queue.run_repeating(evictor.evict_idle, interval=interval,
+                                       first=interval, name='eviction')
+    return evictor
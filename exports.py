@@ -0,0 +1,72 @@
+import csv
+import io
+import tempfile
+
+import billing
+
+
+CHUNK_SIZE = 64 * 1024
+# Kept in memory up to that size, spilled to a temporary file beyond
+MEMORY_LIMIT = 2 ** 20
+COLUMNS = ('party_id', 'date', 'place', 'user_id', 'username', 'first_name',
+           'last_name', 'item', 'cost', 'guest_total', 'paid', 'bill_sent')
+
+
+def guest_records(party):
+    '''Yields a consistent copy of every guest, locking one guest at a time.
+
+    Orders keep coming during the export: the ledger lock is held only while
+    a single guest is copied, not for the whole party.
+    '''
+    for user_id in sorted(list(party['guests'])):
+        with billing.lock:
+            guest = party['guests'].get(user_id)
+            if guest is None:
+                continue
+            guest = billing.as_guest(guest)
+            record = (guest.name, tuple(guest.orders), guest.subtotal,
+                      guest.bill_payd, guest.bill_sent)
+        yield (user_id, *record)
+
+
+def export_rows(party, records):
+    '''Yields the header and a row per order.'''
+    yield COLUMNS
+    for user_id, name, orders, subtotal, paid, sent in records:
+        username, firstname, lastname = name
+        for item, cost in orders:
+            yield (party['id'], party['date'], party['place'], user_id,
+                   username or '', firstname or '', lastname or '', item,
+                   cost, subtotal, int(paid), int(sent))
+
+
+def csv_chunks(rows, chunk_size=CHUNK_SIZE):
+    '''Encodes the rows as CSV, yielding chunks of about chunk_size bytes.'''
+    buffer = io.StringIO()
+    # The BOM and the semicolons let Excel open it as is
+    buffer.write('\ufeff')
+    writer = csv.writer(buffer, delimiter=';')
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def export_party(party):
+    '''Returns a file with the party as CSV, positioned at the start.'''
+    file = tempfile.SpooledTemporaryFile(max_size=MEMORY_LIMIT)
+    for chunk in csv_chunks(export_rows(party, guest_records(party))):
+        file.write(chunk)
+    file.seek(0)
+    return file
+
+
+def send_export(bot, chat_id, party):
+    with export_party(party) as file:
+        bot.send_document(chat_id=chat_id, document=file,
+                          filename=f'party-{party["id"]}.csv',
+                          caption=f'Вечеринка {party["date"]} в '
+                                  f'{party["place"]}')
@@ -0,0 +1,241 @@
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+
+# Length and crc32 of the record that follows
+HEADER = struct.Struct('>II')
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def apply_command(data, command):
+    '''Applies a Redis command to a dict of keys, as Redis would.'''
+    name, key, *args = command
+    key = to_bytes(key)
+    if name == 'set':
+        data[key] = args[0]
+    elif name == 'delete':
+        for name_ in (key, *args):
+            data.pop(to_bytes(name_), None)
+    elif name == 'hset':
+        data.setdefault(key, {})[to_bytes(args[0])] = args[1]
+    elif name == 'hdel':
+        hash_ = data.get(key, {})
+        for field in args:
+            hash_.pop(to_bytes(field), None)
+        if not hash_:
+            data.pop(key, None)
+    elif name == 'sadd':
+        data.setdefault(key, set()).update(to_bytes(value) for value in args)
+    else:
+        raise ValueError(f'Command {name} can not be journaled')
+
+
+class Snapshot:
+    '''Read-only view of the Redis keys recorded in a journal.
+
+    Answers the reads done when the persisted state is loaded, so the bot can
+    start from the journal while Redis is not available.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, name):
+        value = self.data.get(to_bytes(name))
+        return value if isinstance(value, bytes) else None
+
+    def exists(self, *names):
+        return sum(to_bytes(name) in self.data for name in names)
+
+    def hgetall(self, name):
+        value = self.data.get(to_bytes(name))
+        return dict(value) if isinstance(value, dict) else {}
+
+    def smembers(self, name):
+        value = self.data.get(to_bytes(name))
+        return set(value) if isinstance(value, set) else set()
+
+    def pipeline(self, transaction=True):
+        return SnapshotPipeline(self)
+
+
+class SnapshotPipeline:
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.calls = []
+
+    def get(self, name):
+        self.calls.append((self.snapshot.get, name))
+
+    def hgetall(self, name):
+        self.calls.append((self.snapshot.hgetall, name))
+
+    def smembers(self, name):
+        self.calls.append((self.snapshot.smembers, name))
+
+    def execute(self):
+        results = [method(name) for method, name in self.calls]
+        self.calls = []
+        return results
+
+
+class Journal:
+    '''Append-only file of the commands sent to Redis.
+
+    Each record is a list of commands like ``('hset', key, field, value)``,
+    appended before they are sent. Records reach the OS on append and are
+    fsynced in batches every `fsync_interval` seconds (on every append if it
+    is 0), so a crash of the bot loses nothing and a power loss at most the
+    last interval. Records appended after `acknowledge` are pending and are
+    read back by `pending_records` to be replayed. Once nothing is pending and
+    the file is larger than `compact_size` bytes, it is rewritten as a single
+    record setting the keys to their resulting values, so the journal always
+    holds the whole state it was started with.
+    '''
+
+    def __init__(self, path, fsync_interval=1.0, compact_size=4 * 2 ** 20):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_size = compact_size
+        self.lock = threading.RLock()
+        self.file = open(path, 'ab+')
+        # Records of the previous run are pending: it is unknown whether
+        # they reached Redis
+        self.size, self.pending = self._recover()
+        self.acknowledged = 0
+        self.stats = {'appended': 0, 'fsyncs': 0, 'compactions': 0}
+        self._unsynced = False
+        self._closed = threading.Event()
+        self._syncer = None
+        if fsync_interval > 0:
+            self._syncer = threading.Thread(
+                target=self._sync_periodically, name='JournalSync',
+                daemon=True)
+            self._syncer.start()
+
+    def _recover(self):
+        '''Counts the records, dropping a record torn by a crash.'''
+        size = count = 0
+        for size, _ in self._read(0):
+            count += 1
+        if size != os.path.getsize(self.path):
+            self.file.truncate(size)
+        return size, count
+
+    def _read(self, offset):
+        '''Yields the end offset and the commands of every record.'''
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            while True:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, checksum = HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    return
+                offset += HEADER.size + length
+                yield offset, pickle.loads(payload)
+
+    def append(self, commands):
+        payload = pickle.dumps(commands, protocol=pickle.HIGHEST_PROTOCOL)
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            self.file.write(record)
+            self.file.flush()
+            self.size += len(record)
+            self.pending += 1
+            self.stats['appended'] += 1
+            self._unsynced = True
+            if not self._syncer:
+                self.sync()
+
+    def acknowledge(self):
+        '''Marks all records appended so far as applied to Redis.'''
+        with self.lock:
+            self.acknowledged = self.size
+            self.pending = 0
+
+    def pending_records(self, everything=False):
+        '''Yields the commands of the records appended after `acknowledge`,
+        or of all records. Appending while they are read is up to the caller
+        to prevent.'''
+        for offset, commands in self._read(0 if everything
+                                           else self.acknowledged):
+            if offset > self.size:
+                return
+            yield commands
+
+    def read_state(self):
+        '''Returns the keys resulting from all records.'''
+        data = {}
+        for offset, commands in self._read(0):
+            if offset > self.size:
+                break
+            for command in commands:
+                apply_command(data, command)
+        return data
+
+    def snapshot(self):
+        return Snapshot(self.read_state())
+
+    def sync(self):
+        with self.lock:
+            if not self._unsynced:
+                return
+            self._unsynced = False
+            fileno = self.file.fileno()
+            self.stats['fsyncs'] += 1
+        # Appends go on meanwhile, the file is only replaced by compact,
+        # which runs on the same thread
+        os.fsync(fileno)
+
+    def compact(self):
+        '''Rewrites the journal as one record if nothing is pending.'''
+        with self.lock:
+            if self.pending or self.size < self.compact_size:
+                return
+            commands = []
+            for key, value in self.read_state().items():
+                if isinstance(value, bytes):
+                    commands.append(('set', key, value))
+                elif isinstance(value, dict):
+                    commands.extend(('hset', key, field, field_value)
+                                    for field, field_value in value.items())
+                else:
+                    commands.append(('sadd', key, *value))
+            payload = pickle.dumps(commands,
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+            temporary_path = f'{self.path}.compact'
+            with open(temporary_path, 'wb') as file:
+                file.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+                file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, self.path)
+            self.file.close()
+            self.file = open(self.path, 'ab+')
+            self.size = self.acknowledged = HEADER.size + len(payload)
+            self._unsynced = False
+            self.stats['compactions'] += 1
+
+    def _sync_periodically(self):
+        while not self._closed.wait(self.fsync_interval):
+            self.sync()
+            self.compact()
+
+    def close(self):
+        self._closed.set()
+        if self._syncer:
+            self._syncer.join()
+        self.sync()
+        self.file.close()
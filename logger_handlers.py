@@ -1,14 +1,131 @@
 import logging
+import queue
+import threading
+import time
+
 import telegram
 
 
+MESSAGE_LIMIT = 4096
+
+
 class TelegramLogsHandler(logging.Handler):
+    '''Sends log records to a Telegram chat from a background thread.
 
-    def __init__(self, bot_token, chat_id):
+    Records are queued by `emit` and the worker coalesces everything that
+    arrives within `batch_interval` seconds into as few messages as possible,
+    repeated records are sent once with a counter. Records that don't fit the
+    full queue or whose message couldn't be sent are dropped and counted.
+    '''
+
+    def __init__(self, bot_token, chat_id, capacity=1000, batch_interval=2.0,
+                 close_timeout=10.0, base_url=None):
         super().__init__()
         self.chat_id = chat_id
-        self.tg_bot = telegram.Bot(bot_token)
+        self.tg_bot = telegram.Bot(bot_token, base_url=base_url)
+        self.batch_interval = batch_interval
+        self.close_timeout = close_timeout
+        self.records = queue.Queue(maxsize=capacity)
+        self.dropped = 0
+        # Counted by the logging threads and the worker
+        self.dropped_lock = threading.Lock()
+        self.reported_dropped = 0
+        self.sent = 0
+        self._stop = object()
+        self.worker = threading.Thread(target=self._work, daemon=True,
+                                       name='TelegramLogsHandler')
+        self.worker.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.tg_bot.send_message(chat_id=self.chat_id, text=log_entry)
+        try:
+            self.records.put_nowait(self.format(record))
+        except queue.Full:
+            self.count_dropped(1)
+        except Exception:
+            self.handleError(record)
+
+    def _work(self):
+        stopping = False
+        while not stopping:
+            entries = [self.records.get()]
+            deadline = time.monotonic() + self.batch_interval
+            while entries[-1] is not self._stop:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entries.append(self.records.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if entries[-1] is self._stop:
+                stopping = True
+                entries.pop()
+                # Whatever is still queued goes out in the final batch
+                while True:
+                    try:
+                        entries.append(self.records.get_nowait())
+                    except queue.Empty:
+                        break
+            if entries:
+                self._send(entries)
+
+    def count_dropped(self, records):
+        with self.dropped_lock:
+            self.dropped += records
+
+    def _send(self, entries):
+        for text, records in self.pack(self.coalesce(entries)):
+            try:
+                try:
+                    self.tg_bot.send_message(chat_id=self.chat_id, text=text)
+                except telegram.error.RetryAfter as error:
+                    # Sent once more when Telegram allows it
+                    time.sleep(error.retry_after)
+                    self.tg_bot.send_message(chat_id=self.chat_id, text=text)
+                self.sent += 1
+            except Exception:
+                self.count_dropped(records)
+
+    def coalesce(self, entries):
+        '''Returns the entries with the number of records each stands for.'''
+        counts = {}
+        for entry in entries:
+            counts[entry] = counts.get(entry, 0) + 1
+        coalesced = [(entry if count == 1
+                      else f'{entry}\n(повторено {count} раз)', count)
+                     for entry, count in counts.items()]
+        with self.dropped_lock:
+            dropped = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+        if dropped:
+            coalesced.append((f'Пропущено записей лога: {dropped}', 0))
+        return coalesced
+
+    @staticmethod
+    def pack(entries):
+        '''Joins entries into messages that fit the Telegram length limit.
+
+        Takes and returns pairs of a text and the number of records in it.
+        '''
+        messages = []
+        message, records = '', 0
+        for entry, count in entries:
+            if len(entry) > MESSAGE_LIMIT:
+                entry = entry[:MESSAGE_LIMIT - 1] + '…'
+            if message and len(message) + len(entry) + 2 > MESSAGE_LIMIT:
+                messages.append((message, records))
+                message, records = '', 0
+            message = f'{message}\n\n{entry}' if message else entry
+            records += count
+        if message:
+            messages.append((message, records))
+        return messages
+
+    def close(self):
+        if self.worker.is_alive():
+            try:
+                self.records.put(self._stop, timeout=self.close_timeout)
+            except queue.Full:
+                pass
+            self.worker.join(self.close_timeout)
+        super().close()
@@ -0,0 +1,170 @@
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from billing import Order
+
+
+MAX_RESULTS = 5
+MAX_BUTTONS = 50
+MIN_SCORE = 0.4
+# The price follows a dash or a colon, so "Кола 0.3 - 100" keeps its volume
+MENU_LINE = re.compile(r'^\s*(?P<item>.+?)\s*[-–—:]\s*(?P<cost>\d+)\s*'
+                       r'(?:руб\.?|р\.?|₽)?\s*$', re.IGNORECASE)
+
+
+def normalize(text):
+    text = text.lower().replace('ё', 'е')
+    return ' '.join(re.sub(r'[^\w]+', ' ', text).split())
+
+
+def trigrams(word):
+    padded = f' {word} '
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+class MenuIndex:
+    '''Prefix and trigram index of the words of the menu item names.
+
+    The distinct words are kept sorted, so words starting with a query word
+    are found by bisection, and every trigram points to the words containing
+    it, so a misspelled query word is compared only with the words sharing a
+    trigram with it instead of with every item.
+    '''
+
+    def __init__(self, items):
+        self.items = items
+        self.names = {}
+        word_items = defaultdict(set)
+        for index, item in enumerate(items):
+            name = normalize(item.item)
+            self.names.setdefault(name, index)
+            for word in name.split():
+                word_items[word].add(index)
+        self.words = sorted(word_items)
+        self.word_items = [word_items[word] for word in self.words]
+        self.word_sizes = []
+        self.postings = defaultdict(list)
+        for word_id, word in enumerate(self.words):
+            word_trigrams = trigrams(word)
+            self.word_sizes.append(len(word_trigrams))
+            for trigram in word_trigrams:
+                self.postings[trigram].append(word_id)
+
+    def find(self, name):
+        '''Returns the index of the item with exactly this name or None.'''
+        return self.names.get(normalize(name))
+
+    def similar_words(self, word):
+        '''Returns the similarity of the indexed words close to the word.'''
+        similar = {}
+        position = bisect_left(self.words, word)
+        while position < len(self.words) \
+                and self.words[position].startswith(word):
+            similar[position] = 1.0
+            position += 1
+        word_trigrams = trigrams(word)
+        shared = defaultdict(int)
+        for trigram in word_trigrams:
+            for word_id in self.postings.get(trigram, ()):
+                shared[word_id] += 1
+        for word_id, count in shared.items():
+            similarity = 2 * count / (len(word_trigrams)
+                                      + self.word_sizes[word_id])
+            similar[word_id] = max(similar.get(word_id, 0), similarity)
+        return similar
+
+    def search(self, query, limit=MAX_RESULTS):
+        '''Returns indexes of the items best matching the query.'''
+        words = normalize(query).split()
+        if not words:
+            return list(range(min(limit, len(self.items))))
+        scores = defaultdict(float)
+        for word in words:
+            best = {}
+            for word_id, similarity in self.similar_words(word).items():
+                for index in self.word_items[word_id]:
+                    best[index] = max(best.get(index, 0), similarity)
+            for index, similarity in best.items():
+                scores[index] += similarity / len(words)
+        matches = [index for index, score in scores.items()
+                   if score >= MIN_SCORE]
+        matches.sort(key=lambda index: (-scores[index],
+                                        self.items[index].item))
+        return matches[:limit]
+
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def get_index(party):
+    '''Returns the index of the party menu, built once per menu version.'''
+    if not party or not party.get('menu'):
+        return None
+    version = party.get('menu_version')
+    with indexes_lock:
+        cached = indexes.get(party['id'])
+        if cached is None or cached[0] != version:
+            cached = (version, MenuIndex(party['menu']))
+            indexes[party['id']] = cached
+    return cached[1]
+
+
+def forget_index(party_id):
+    with indexes_lock:
+        indexes.pop(party_id, None)
+
+
+def forget_indexes():
+    with indexes_lock:
+        indexes.clear()
+
+
+def parse_menu(text):
+    '''Parses "name - price" lines, returns the items and unparsed lines.'''
+    items, rejected = [], []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = MENU_LINE.match(line)
+        if match:
+            items.append(Order(match['item'].strip(), int(match['cost'])))
+        else:
+            rejected.append(line.strip())
+    return items, rejected
+
+
+def set_menu(party, items):
+    party['menu'] = items
+    party['menu_version'] = party.get('menu_version', 0) + 1
+
+
+def get_item(party, callback_data):
+    '''Returns the item of a menu button, None if the menu changed since.'''
+    _, version, index = callback_data.split(':')
+    menu = party.get('menu') or []
+    if int(version) != party.get('menu_version') or int(index) >= len(menu):
+        return None
+    return menu[int(index)]
+
+
+def format_menu(party):
+    return '\n'.join(f'{item} - {cost}руб.' for item, cost in party['menu'])
+
+
+def build_keyboard(party, item_indexes, search_button=False):
+    version = party.get('menu_version')
+    keyboard = [
+        [InlineKeyboardButton(f'{party["menu"][index].item} - '
+                              f'{party["menu"][index].cost}руб.',
+                              callback_data=f'menu:{version}:{index}')]
+        for index in item_indexes[:MAX_BUTTONS]
+    ]
+    if search_button:
+        keyboard.append([InlineKeyboardButton(
+            '🔎 Поиск по меню', switch_inline_query_current_chat='')])
+    return InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,174 @@
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Up to a minute for the time orders wait for their digest
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           float('inf'))
+
+
+class Histogram:
+    '''Latency histogram with fixed buckets, counts and errors.'''
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        with self.lock:
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    self.buckets[index] += 1
+                    break
+            self.count += 1
+            self.errors += error
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        '''Upper bound of the bucket holding the given fraction of samples.'''
+        with self.lock:
+            rank = fraction * self.count
+            cumulative = 0
+            for bound, count in zip(BUCKETS, self.buckets):
+                cumulative += count
+                if count and cumulative >= rank:
+                    return min(bound, self.max)
+            return self.max
+
+
+started = time.monotonic()
+histograms = {}
+histograms_lock = threading.Lock()
+counters = {}
+
+
+def get_histogram(name):
+    histogram = histograms.get(name)
+    if histogram is None:
+        with histograms_lock:
+            histogram = histograms.setdefault(name, Histogram())
+    return histogram
+
+
+def increment(name, value=1):
+    with histograms_lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def instrument(function, name=None):
+    '''Wraps a callable to record its latency and errors under `name`.'''
+    histogram = get_histogram(name or function.__name__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        error = False
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start, error)
+    return wrapper
+
+
+def instrument_conversation(conversation):
+    '''Instruments callbacks of all handlers of a ConversationHandler.'''
+    handlers = list(conversation.entry_points) + list(conversation.fallbacks)
+    for state_handlers in conversation.states.values():
+        handlers.extend(state_handlers)
+    # Handlers shared by several states are instrumented once
+    for handler in dict.fromkeys(handlers):
+        handler.callback = instrument(handler.callback,
+                                      f'handler.{handler.callback.__name__}')
+
+
+def instrument_methods(obj, names, prefix):
+    for name in names:
+        setattr(obj, name, instrument(getattr(obj, name), f'{prefix}.{name}'))
+
+
+def format_stats(persistence=None):
+    uptime = time.monotonic() - started
+    text = f'Время работы: {uptime / 60:.0f} мин.\n\n'
+    for name, histogram in sorted(histograms.items()):
+        if not histogram.count:
+            continue
+        text += f'{name}: {histogram.count} ' \
+                f'({histogram.count / uptime * 60:.1f}/мин), ' \
+                f'ошибок {histogram.errors}\n' \
+                f'\tavg {histogram.total / histogram.count * 1000:.1f}ms, ' \
+                f'p50 ≤{histogram.percentile(0.5) * 1000:.0f}ms, ' \
+                f'p99 ≤{histogram.percentile(0.99) * 1000:.0f}ms, ' \
+                f'max {histogram.max * 1000:.0f}ms\n'
+    if counters:
+        text += '\n' + ''.join(f'{name}: {value}\n'
+                                for name, value in sorted(counters.items()))
+    checked = sum(counters.get(f'receipts.{outcome}', 0)
+                  for outcome in ('matched', 'mismatched', 'unreadable',
+                                  'failed'))
+    if checked:
+        matched = counters.get('receipts.matched', 0)
+        text += f'\nЧеки: оплата подтверждена автоматически по {matched} ' \
+                f'из {checked} ({matched / checked:.0%})\n'
+    if persistence:
+        stats = persistence.stats
+        text += f'\nRedis: {stats["flushes"]} записей, ' \
+                f'{stats["bytes_written"] / 1024:.0f}КБ, ' \
+                f'загрузка {stats["load_seconds"] * 1000:.0f}ms\n'
+        if stats['offline']:
+            text += f'Redis недоступен, записей в журнале: ' \
+                    f'{stats["journal_pending"]}\n'
+    return text
+
+
+def format_prometheus(persistence=None):
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        metric = 'party_bot_' + name.replace('.', '_')
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.buckets):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else bound
+            lines.append(f'{metric}_seconds_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f'{metric}_seconds_sum {histogram.total}')
+        lines.append(f'{metric}_seconds_count {histogram.count}')
+        lines.append(f'{metric}_errors_total {histogram.errors}')
+    for name, value in sorted(counters.items()):
+        lines.append(f'party_bot_{name.replace(".", "_")}_total {value}')
+    if persistence:
+        for name, value in persistence.stats.items():
+            lines.append(f'party_bot_persistence_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def start_http_server(host, port, persistence=None):
+    '''Serves the metrics in Prometheus text format on /metrics.'''
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = format_prometheus(persistence).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name='MetricsServer').start()
+    return server
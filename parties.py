@@ -0,0 +1,83 @@
+import logging
+import secrets
+
+import analytics
+import billing
+import deposits
+import menu
+
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_DATE = '09 Марта 2024г.'
+DEFAULT_PLACE = 'баре Freedom'
+
+
+def create_party(bot_data, admin_chat_id, date=DEFAULT_DATE,
+                 place=DEFAULT_PLACE, party_id=None):
+    party_id = party_id or secrets.token_hex(4)
+    party = {
+        'id': party_id,
+        'admin_chat_id': admin_chat_id,
+        'date': date,
+        'place': place,
+        'status': 'in progress',
+        'guests': {},
+    }
+    billing.rebuild_ledger(party)
+    bot_data.setdefault('parties', {})[party_id] = party
+    return party
+
+
+def migrate_bot_data(bot_data, admin_chat_id):
+    '''Turns the single party of older versions into the first of the parties.'''
+    bot_data.pop('admin_chat_id', None)
+    party = bot_data.pop('party', None)
+    if party is None:
+        return None
+    party['id'] = str(abs(admin_chat_id))
+    party['admin_chat_id'] = admin_chat_id
+    bot_data.setdefault('parties', {})[party['id']] = party
+    logger.info(f'Party migrated as {party["id"]}')
+    return party
+
+
+def get_admin_party(bot_data, chat_id):
+    '''Returns the party managed from the admin chat.'''
+    for party in bot_data.get('parties', {}).values():
+        if party['admin_chat_id'] == chat_id:
+            return party
+    return None
+
+
+def get_guest_party(bot_data, user_data, user_id):
+    '''Returns the party the guest joined, the only party if there is one.'''
+    parties = bot_data.get('parties', {})
+    party = parties.get(user_data.get('party_id'))
+    if party is not None:
+        return party
+    for party in parties.values():
+        if user_id in party['guests']:
+            return party
+    if len(parties) == 1:
+        return next(iter(parties.values()))
+    return None
+
+
+def archive_party(bot_data, party_id, store=None):
+    '''Moves the party out of bot_data to the archive of the store.'''
+    party = bot_data['parties'].pop(party_id)
+    with billing.lock:
+        party.pop('ledger', None)
+    menu.forget_index(party_id)
+    deposits.forget(party_id)
+    party['analytics'] = analytics.forget(party)
+    if store:
+        store.archive_party(party)
+    else:
+        bot_data.setdefault('archive', {})[party_id] = party
+    return party
+
+
+def get_invite_link(bot, party):
+    return f'https://t.me/{bot.username}?start={party["id"]}'
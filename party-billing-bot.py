@@ -3,17 +3,37 @@ import os
 import re
 import traceback
 from enum import Enum
+from queue import Queue
 
 import redis
 from dotenv import load_dotenv
-from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+from telegram import (Bot, InlineKeyboardButton, InlineKeyboardMarkup,
+                      InlineQueryResultArticle, InputTextMessageContent,
                       ReplyKeyboardMarkup, ReplyKeyboardRemove)
+from telegram.error import BadRequest
 from telegram.ext import (CallbackQueryHandler, CommandHandler,
-                          ConversationHandler, Filters, MessageHandler,
-                          Updater)
-
+                          ConversationHandler, Filters, InlineQueryHandler,
+                          JobQueue, MessageHandler, Updater)
+from telegram.utils.request import Request
+
+import analytics
+import billing
+import broadcast
+import deposits
+import digests
+import eviction
+import exports
+import menu
+import metrics
+import parties
+import receipts
+import reports
+from chat_dispatcher import ChatOrderedDispatcher
+from codec import Codec
+from journal import Journal
 from logger_handlers import TelegramLogsHandler
-from persistence import RedisPersistence
+from persistence import (REDIS_UNAVAILABLE, RedisPersistence,
+                         ShardedRedisPersistence)
 
 
 logger = logging.getLogger(__file__)
@@ -26,26 +46,20 @@ class ConversationStatus(Enum):
     ADM_COMMANDS = 100
 
 
-def get_user_bill(update, context, user_id):
-    guest = context.bot_data['party']['guests'][user_id]
-    text = ''
-    username, firstname, lastname = guest['name']
-    summary_name = f'{firstname} ' if firstname else ''
-    summary_name += f'{lastname}' if lastname else ''
-    summary_name += f'(@{username})' if username else ''
-    text += f'Гость {summary_name}:\n'
-    items = guest['orders']
-    subtotal = 0
-    for (item, cost) in items:
-        text += f'\t{item} - {cost}руб.\n'
-        subtotal += cost
-    text += f'User total: {subtotal}руб.\n'
-    negate_payd = '' if guest['bill_payd'] else 'не '
-    text += f'Счет {negate_payd}оплачен.\n'
+def get_admin_party(update, context):
+    return parties.get_admin_party(context.bot_data, update.effective_chat.id)
+
+
+def get_guest_party(update, context):
+    return parties.get_guest_party(context.bot_data, context.user_data,
+                                   update.effective_user.id)
+
+
+def get_user_bill(update, context, party, user_id):
+    guest = party['guests'][user_id]
+    text = reports.format_guest_summary(guest)
     reply_markup = None
-    if not guest['bill_payd']:
-        negate_sent = '' if guest['bill_sent'] else 'не '
-        text += f'Счет {negate_sent}отправлен.\n'
+    if not guest.bill_payd:
         keyboard = [
             [InlineKeyboardButton('✉ Отправить счет 🧾',
                                   callback_data=f'sendbill:{user_id}')],
@@ -55,40 +69,28 @@ def get_user_bill(update, context, user_id):
         reply_markup = InlineKeyboardMarkup(keyboard)
     context.bot.send_message(chat_id=update.effective_chat.id, text=text,
                              reply_markup=reply_markup)
-    return subtotal
+    return guest.subtotal
 
 
-def send_user_bill(update, context, user_id):
-    guest = context.bot_data['party']['guests'][user_id]
-    text = ''
-    username, firstname, lastname = guest['name']
-    summary_name = f'{firstname} ' if firstname else ''
-    summary_name += f'{lastname}' if lastname else ''
-    summary_name += f'(@{username})' if username else ''
-    text += f'Гость {summary_name}:\n'
-    items = guest['orders']
-    subtotal = 0
-    for (item, cost) in items:
-        text += f'\t{item} - {cost}руб.\n'
-        subtotal += cost
-    text += f'User total: {subtotal}руб.\n'
-    text += 'Счет оплачивать переводом на номер 89110327182 (Сбер или ' \
-            'Тинькофф)\nПосле оплаты чек из банковского приложения отправь ' \
-            'сюда боту.\nОбычно приложение отправляет чек в формате PDF, но ' \
-            'если ты захочешь отправить скриншот экрана, то отправляй ' \
-            'картинку БЕЗ сжатия.\n'
-    negate_payd = '' if guest['bill_payd'] else 'не '
-    text += f'Счет {negate_payd}оплачен.\n'
-    guest['bill_sent'] = True
-    text += 'Счет отправлен.\n'
-    context.bot.send_message(chat_id=user_id, text=text, )
+def send_user_bill(update, context, party, user_id):
+    guest = party['guests'][user_id]
+    context.bot.send_message(chat_id=user_id,
+                             text=reports.format_user_bill(guest), )
+    billing.mark_bill_sent(party, user_id)
 
 
 def help(update, context):
-    logger.debug(f'Enter help: {update=}')
-
-    date = context.bot_data['party'].get('date', '')
-    place = context.bot_data['party'].get('place', '')
+    logger.debug('Enter help: update=%r', update)
+
+    party = get_guest_party(update, context)
+    if party is None:
+        text = 'Привет!\nЯ учитываю заказы нашей компании на вечеринках.\n' \
+               'Чтобы присоединиться к вечеринке, открой ссылку-приглашение ' \
+               'от организаторов.'
+        context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        return ConversationHandler.END
+    date = party.get('date', '')
+    place = party.get('place', '')
     text = 'Привет!\n' \
            'Я учитываю заказы нашей компании на вечеринке ' \
            f'{date} в {place}\nЕсли ты участник этой вечеринки, то пришли ' \
@@ -98,37 +100,48 @@ def help(update, context):
 
 
 def adm_help(update, context):
-    logger.debug(f'Enter adm_help: {update=}')
+    logger.debug('Enter adm_help: update=%r', update)
 
     text = 'Привет!\n' \
            'Ты находишься в административном канале где происходит ' \
            'управление ботом.\n Бот выполняет следующие команды:\n' \
-           '/startparty - запускает прием заказов на вечеринке\n' \
+           '/startparty [дата; место] - начинает новую вечеринку, ' \
+           'текущая переносится в архив\n' \
            '/closeparty - останавливает прием заказов и рассылает счет всем ' \
            'участникам, у кого он не погашен\n' \
            '/total - выводит информацию о текущем счете всех участников\n' \
-           '/party - выводит информацию о текущей вечеринке'
+           '/party - выводит информацию о текущей вечеринке\n' \
+           '/menu - показывает или задает меню с ценами\n' \
+           '/deposit [сумма] - показывает остаток или задает депозит ' \
+           'вечеринки\n' \
+           '/analytics - продажи по времени и популярные позиции\n' \
+           '/export [id] - выгружает заказы текущей или архивной ' \
+           'вечеринки в CSV\n' \
+           '/stats - статистика времени обработки команд'
     context.bot.send_message(chat_id=update.effective_chat.id, text=text)
     return ConversationStatus.ADM_COMMANDS
 
 
 def start(update, context):
-    logger.debug(f'Enter cmd_start: {update=}')
+    logger.debug('Enter cmd_start: update=%r', update)
 
     user_id = update.message.from_user.id
     username = update.message.from_user['username']
     firstname = update.message.from_user['first_name']
     lastname = update.message.from_user['last_name']
 
-    guests = context.bot_data['party']['guests']
-    if user_id not in guests:
-        guests[user_id] = {'name': (username, firstname, lastname),
-                           'bill_sent': False,
-                           'bill_payd': False,
-                           'orders': [('Бронирование', 300)], }
-
-    date = context.bot_data['party'].get('date', '')
-    place = context.bot_data['party'].get('place', '')
+    party = context.bot_data.get('parties', {}).get(
+        context.args[0] if context.args else None)
+    if party is None:
+        party = get_guest_party(update, context)
+    if party is None:
+        return help(update, context)
+    context.user_data['party_id'] = party['id']
+    if user_id not in party['guests']:
+        billing.add_guest(party, user_id, (username, firstname, lastname))
+
+    date = party.get('date', '')
+    place = party.get('place', '')
     text = f'Всем привет!\nЖдем вас на вечеринке {date} в {place}.\n' \
            'Это демо версия бота для учета заказов, пожалуйста, не серчайте ' \
            'за баги).\nОн отправляет ваш заказ официанту и суммирует его '\
@@ -144,18 +157,26 @@ def start(update, context):
 
 
 def get_item(update, context):
-    logger.debug(f'Enter save_item: {update=}')
+    logger.debug('Enter save_item: update=%r', update)
 
     item = update.message.text
     context.user_data['item'] = item
     text = f'Ты заказал(а):\n{item}\nТеперь напиши общуюсь стоимость всех ' \
            'позиций. Отменить заказ или исправить можно после следующего шага.'
-    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    reply_markup = None
+    party = get_guest_party(update, context)
+    menu_index = menu.get_index(party)
+    matches = menu_index.search(item) if menu_index else []
+    if matches:
+        text += '\nИли выбери позицию из меню, чтобы заказать ее сразу:'
+        reply_markup = menu.build_keyboard(party, matches)
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text,
+                             reply_markup=reply_markup)
     return ConversationStatus.GET_COST
 
 
 def get_cost(update, context):
-    logger.debug(f'Enter save_cost: {update=}')
+    logger.debug('Enter save_cost: update=%r', update)
 
     if re.search(r'[^0-9]', update.message.text):
         text = 'Введите просто цифры! Без посторонних символов!'
@@ -175,44 +196,135 @@ def get_cost(update, context):
 
 
 def confirm_choice(update, context):
-    logger.debug(f'Enter confirm_choice: {update=}')
+    logger.debug('Enter confirm_choice: update=%r', update)
+
+    return place_order(update, context, context.user_data['item'],
+                       context.user_data['cost'])
+
 
-    if context.bot_data['party']['status'] == 'closed':
+def place_order(update, context, item, cost):
+    user_id = update.effective_user.id
+    party = get_guest_party(update, context)
+    if party is None or party['status'] == 'closed' \
+            or user_id not in party['guests']:
         text = 'Бот завершил работу, новые заказы будут принимать только за ' \
                'стойкой бара'
         context.bot.send_message(chat_id=update.effective_chat.id, text=text,
                                  reply_markup=ReplyKeyboardRemove(), )
         return ConversationHandler.END
 
-    cost = context.user_data['cost']
-    item = context.user_data['item']
+    accepted, spent = deposits.reserve(party, cost)
+    if not accepted:
+        remaining = deposits.get_limit(party) - spent
+        if remaining > 0:
+            text = 'Этот заказ не помещается в депозит вечеринки: осталось ' \
+                   f'{remaining}руб. Закажи что-нибудь подешевле или сделай ' \
+                   'заказ за стойкой бара.'
+        else:
+            text = 'Депозит вечеринки исчерпан, новые заказы принимают ' \
+                   'только за стойкой бара.'
+        context.bot.send_message(chat_id=update.effective_chat.id, text=text,
+                                 reply_markup=ReplyKeyboardRemove(), )
+        return ConversationStatus.GET_ITEM
+
     text = f'Спасибо, что ты заказал:\n{item}\nСтоимостью:\n{cost}\n' \
            'Спуститесь за заказом через 5 минут (горячие блюда могут ' \
            'готовится дольше).\nЧтобы сделать новый заказ снова пришлите ' \
            'наименование позиций.'
     context.bot.send_message(chat_id=update.effective_chat.id, text=text,
                              reply_markup=ReplyKeyboardRemove(), )
-    user_id = update.message.from_user.id
-    username = update.message.from_user['username']
-    firstname = update.message.from_user['first_name']
-    lastname = update.message.from_user['last_name']
+    username = update.effective_user['username']
+    firstname = update.effective_user['first_name']
+    lastname = update.effective_user['last_name']
 
-    guests = context.bot_data['party']['guests']
-    user = guests.get(user_id)
-    user['orders'].append((item, cost))
+    try:
+        billing.add_order(party, user_id, item, cost)
+    except Exception:
+        deposits.release(party, cost)
+        raise
+    analytics.record_order(party, item, cost)
+    for threshold in deposits.crossed_thresholds(party, cost, spent):
+        limit = deposits.get_limit(party)
+        text = f'Депозит израсходован на {threshold}%: заказано на ' \
+               f'{spent} из {limit}руб., осталось {max(limit - spent, 0)}руб.'
+        context.bot.send_message(chat_id=party['admin_chat_id'], text=text)
 
     summary_name = f'{firstname} ' if firstname else ''
     summary_name += f'{lastname}' if lastname else ''
     summary_name += f'(@{username})' if username else ''
-    text = f'Пользователь {summary_name}:\n' \
-           f'{item} - {cost}руб.'
-    context.bot.send_message(chat_id=context.bot_data['admin_chat_id'],
-                             text=text, )
+    digests.order_digest.add_order(context.bot, party['admin_chat_id'],
+                                   user_id, f'Пользователь {summary_name}',
+                                   item, cost)
+    return ConversationStatus.GET_ITEM
+
+
+def order_menu_item(update, context):
+    logger.debug('Enter order_menu_item: update=%r', update)
+
+    party = get_guest_party(update, context)
+    item = menu.get_item(party, update.callback_query.data) \
+        if party else None
+    if item is None:
+        update.callback_query.answer('Меню изменилось, открой его заново: '
+                                     '/menu')
+        return ConversationStatus.GET_ITEM
+    update.callback_query.answer()
+    return place_order(update, context, item.item, item.cost)
+
+
+def order_inline_choice(update, context):
+    logger.debug('Enter order_inline_choice: update=%r', update)
+
+    party = get_guest_party(update, context)
+    menu_index = menu.get_index(party)
+    index = menu_index.find(update.message.text) if menu_index else None
+    if index is None:
+        return get_item(update, context)
+    item = party['menu'][index]
+    return place_order(update, context, item.item, item.cost)
+
+
+def show_menu(update, context):
+    logger.debug('Enter show_menu: update=%r', update)
+
+    party = get_guest_party(update, context)
+    if party is None:
+        return help(update, context)
+    if not party.get('menu'):
+        text = 'Меню пока нет. Напиши наименование позиций, которые ты ' \
+               'хочешь заказать:'
+        context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        return ConversationStatus.GET_ITEM
+    text = 'Меню:\n' \
+           f'{menu.format_menu(party)}\n' \
+           'Нажми на позицию, чтобы заказать ее, или напиши заказ текстом.'
+    reply_markup = menu.build_keyboard(
+        party, list(range(len(party['menu']))), search_button=True)
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text,
+                             reply_markup=reply_markup)
     return ConversationStatus.GET_ITEM
 
 
+def inline_menu(update, context):
+    logger.debug('Enter inline_menu: update=%r', update)
+
+    party = parties.get_guest_party(context.bot_data, context.user_data,
+                                    update.inline_query.from_user.id)
+    menu_index = menu.get_index(party)
+    results = []
+    if menu_index:
+        for index in menu_index.search(update.inline_query.query,
+                                       limit=menu.MAX_BUTTONS):
+            item, cost = party['menu'][index]
+            results.append(InlineQueryResultArticle(
+                id=f'{party["menu_version"]}:{index}', title=item,
+                description=f'{cost}руб.',
+                input_message_content=InputTextMessageContent(item)))
+    update.inline_query.answer(results, cache_time=10, is_personal=True)
+
+
 def decline_choice(update, context):
-    logger.debug(f'Enter decline_choice: {update=}')
+    logger.debug('Enter decline_choice: update=%r', update)
 
     text = 'Отмена. Чтобы сделать заказ снова пришлите наименование позиций.'
     context.bot.send_message(chat_id=update.effective_chat.id, text=text,
@@ -221,54 +333,61 @@ def decline_choice(update, context):
 
 
 def forward_document(update, context):
-    logger.debug(f'Enter forward_document: {update=}')
+    logger.debug('Enter forward_document: update=%r', update)
 
-    update.message.forward(context.bot_data['admin_chat_id'])
+    party = get_guest_party(update, context)
+    if party is None:
+        return
+    if receipts.receipt_matcher \
+            and update.effective_user.id in party['guests']:
+        receipts.receipt_matcher.submit(party, update.effective_user.id,
+                                        update.message)
+    else:
+        update.message.forward(party['admin_chat_id'])
 
 
 def adm_total(update, context):
-    logger.debug(f'Enter adm_total: {update=}')
-
-    guests = context.bot_data['party']['guests']
-    total = 0
-    for user_id in guests:
-        total += get_user_bill(update, context, user_id)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f'Общая сумма за вечер: {total}руб.')
+    logger.debug('Enter adm_total: update=%r', update)
+
+    text, reply_markup = reports.render_report(
+        get_admin_party(update, context), 'total', 0)
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text,
+                             reply_markup=reply_markup)
     return ConversationStatus.ADM_COMMANDS
 
 
 def adm_debtors(update, context):
-    logger.debug(f'Enter adm_debtors: {update=}')
-
-    guests = context.bot_data['party']['guests']
-    total = 0
-    for user_id, guest in guests.items():
-        if not guest['bill_payd']:
-            total += get_user_bill(update, context, user_id)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f'Сумма неоплаченных счетов: {total}руб.')
+    logger.debug('Enter adm_debtors: update=%r', update)
+
+    text, reply_markup = reports.render_report(
+        get_admin_party(update, context), 'debtors', 0)
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text,
+                             reply_markup=reply_markup)
     return ConversationStatus.ADM_COMMANDS
 
 
 def adm_sendbills(update, context):
-    logger.debug(f'Enter adm_debtors: {update=}')
-
-    guests = context.bot_data['party']['guests']
-    total = 0
-    for user_id, guest in guests.items():
-        if not guest['bill_payd']:
-            total += 1
-            send_user_bill(update, context, user_id)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f'Отправлено {total} неоплаченных счетов.')
+    logger.debug('Enter adm_debtors: update=%r', update)
+
+    party = get_admin_party(update, context)
+    if broadcast.is_running(party):
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='Рассылка счетов уже идет.')
+        return ConversationStatus.ADM_COMMANDS
+    unpaid = billing.get_unpaid(party)
+    if not unpaid:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='Нет неоплаченных счетов.')
+        return ConversationStatus.ADM_COMMANDS
+    broadcast.start_broadcast(context.bot, context.job_queue, party, unpaid,
+                              update.effective_chat.id)
     return ConversationStatus.ADM_COMMANDS
 
 
 def adm_close(update, context):
-    logger.debug(f'Enter adm_close: {update=}')
+    logger.debug('Enter adm_close: update=%r', update)
 
-    context.bot_data['party']['status'] = 'closed'
+    get_admin_party(update, context)['status'] = 'closed'
     text = 'Вечеринка закрыта.\nИспользуйте следующие команды:\n' \
            '/sendbills - отправить счета всем, кто еще не оплатил\n' \
            '/total - получить полный подсчет по всем участникам вечеринки\n' \
@@ -278,24 +397,125 @@ def adm_close(update, context):
 
 
 def adm_start_party(update, context):
-    logger.debug(f'Enter adm_start_party: {update=}')
+    logger.debug('Enter adm_start_party: update=%r', update)
+
+    previous = get_admin_party(update, context)
+    date, place = previous['date'], previous['place']
+    if context.args:
+        date, _, place = ' '.join(context.args).partition(';')
+        date, place = date.strip(), place.strip() or previous['place']
+    parties.archive_party(context.bot_data, previous['id'],
+                          context.dispatcher.persistence or None)
+    party = parties.create_party(context.bot_data, update.effective_chat.id,
+                                 date=date, place=place)
+    text = 'Предыдущая вечеринка перенесена в архив, новая вечеринка ' \
+           f'{date} в {place} запущена.\nСсылка-приглашение для гостей: ' \
+           f'{parties.get_invite_link(context.bot, party)}\n' \
+           f'Выгрузить заказы предыдущей вечеринки: /export {previous["id"]}'
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    return ConversationStatus.ADM_COMMANDS
+
+
+def adm_menu(update, context):
+    logger.debug('Enter adm_menu: update=%r', update)
+
+    party = get_admin_party(update, context)
+    lines = update.message.text.partition('\n')[2]
+    if not lines.strip():
+        text = 'Чтобы задать меню, пришли команду /menu и с новой строки ' \
+               'позиции, по одной на строку, например:\n' \
+               '/menu\nПиво светлое 0.5 - 250\nГренки с чесноком - 300'
+        if party.get('menu'):
+            text = f'Текущее меню:\n{menu.format_menu(party)}\n\n{text}'
+        context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        return ConversationStatus.ADM_COMMANDS
+    items, rejected = menu.parse_menu(lines)
+    menu.set_menu(party, items)
+    text = f'Меню обновлено, позиций: {len(items)}.'
+    if rejected:
+        text += '\nНе удалось разобрать строки:\n' + '\n'.join(rejected)
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    return ConversationStatus.ADM_COMMANDS
+
+
+def adm_deposit(update, context):
+    logger.debug('Enter adm_deposit: update=%r', update)
+
+    party = get_admin_party(update, context)
+    if context.args and context.args[0].isdigit():
+        party['deposit'] = int(context.args[0])
+    elif context.args:
+        text = 'Сумму депозита нужно указать цифрами, например /deposit ' \
+               '50000. /deposit 0 отменяет депозит.'
+        context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        return ConversationStatus.ADM_COMMANDS
+    limit = deposits.get_limit(party)
+    if limit:
+        text = f'Депозит вечеринки: {limit}руб., заказано на ' \
+               f'{deposits.get_spent(party)}руб., осталось ' \
+               f'{deposits.get_remaining(party)}руб.'
+    else:
+        text = 'Депозит не задан, заказы принимаются без ограничения. ' \
+               'Задать его можно командой /deposit <сумма>.'
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    return ConversationStatus.ADM_COMMANDS
+
+
+def adm_analytics(update, context):
+    logger.debug('Enter adm_analytics: update=%r', update)
+
+    text = analytics.format_analytics(get_admin_party(update, context))
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    return ConversationStatus.ADM_COMMANDS
+
+
+def adm_export(update, context):
+    logger.debug('Enter adm_export: update=%r', update)
+
+    chat_id = update.effective_chat.id
+    party = get_admin_party(update, context)
+    if context.args:
+        party_id = context.args[0]
+        persistence = context.dispatcher.persistence
+        try:
+            party = persistence.load_archived_party(party_id) \
+                if persistence \
+                else context.bot_data.get('archive', {}).get(party_id)
+        except REDIS_UNAVAILABLE:
+            text = 'Архив сейчас недоступен, попробуй позже.'
+            context.bot.send_message(chat_id=chat_id, text=text)
+            return ConversationStatus.ADM_COMMANDS
+        if party is None or party['admin_chat_id'] != chat_id:
+            text = f'Вечеринки {party_id} нет в архиве этого чата.'
+            context.bot.send_message(chat_id=chat_id, text=text)
+            return ConversationStatus.ADM_COMMANDS
+    # Big parties take a while, orders are handled meanwhile
+    context.dispatcher.run_async(
+        metrics.instrument(exports.send_export, 'export'),
+        context.bot, chat_id, party)
+    return ConversationStatus.ADM_COMMANDS
+
+
+def adm_stats(update, context):
+    logger.debug('Enter adm_stats: update=%r', update)
 
-    context.bot_data['party']['status'] = 'in progress'
-    context.bot_data['party']['guests'] = {}
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text='Все счета удалены, вечеринка запущена.')
+    text = metrics.format_stats(context.dispatcher.persistence)
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
     return ConversationStatus.ADM_COMMANDS
 
 
 def adm_party_info(update, context):
-    logger.debug(f'Enter adm_party_info: {update=}')
-    date = context.bot_data['party']['date']
-    place = context.bot_data['party']['place']
-    status = context.bot_data['party']['status']
+    logger.debug('Enter adm_party_info: update=%r', update)
+    party = get_admin_party(update, context)
+    date = party['date']
+    place = party['place']
+    status = party['status']
     text = 'Информация о текущей вечеринке:\n' \
            f'Дата вечеринки: {date}\n' \
            f'Место вечеринки (в): {place}\n' \
-           f'Статус вечеринки: {status}'
+           f'Статус вечеринки: {status}\n' \
+           'Ссылка-приглашение: ' \
+           f'{parties.get_invite_link(context.bot, party)}'
     keyboard = [
         [InlineKeyboardButton('Изменить дату вечеринки (не работает)',
                               callback_data='change_party_date')],
@@ -313,23 +533,63 @@ def adm_party_info(update, context):
     return ConversationStatus.ADM_COMMANDS
 
 
+def edit_report_page(update, context, kind, page_number):
+    text, reply_markup = reports.render_report(
+        get_admin_party(update, context), kind, page_number)
+    try:
+        update.callback_query.edit_message_text(text,
+                                                reply_markup=reply_markup)
+    except BadRequest as error:
+        if 'not modified' not in str(error):
+            raise
+
+
+def adm_report_page(update, context):
+    _, kind, page_number = update.callback_query.data.split(':')
+    update.callback_query.answer()
+    edit_report_page(update, context, kind, int(page_number))
+    return ConversationStatus.ADM_COMMANDS
+
+
 def adm_send_bill(update, context):
-    user_id = int(update.callback_query.data.split(':')[1])
-    send_user_bill(update, context, user_id)
-    get_user_bill(update, context, user_id)
+    _, user_id, *report_page = update.callback_query.data.split(':')
+    party = get_admin_party(update, context)
+    send_user_bill(update, context, party, int(user_id))
+    if report_page:
+        kind, page_number = report_page
+        edit_report_page(update, context, kind, int(page_number))
+    else:
+        get_user_bill(update, context, party, int(user_id))
     return ConversationStatus.ADM_COMMANDS
 
 
 def adm_close_bill(update, context):
-    user_id = int(update.callback_query.data.split(':')[1])
-    guest = context.bot_data['party']['guests'][user_id]
-    guest['bill_payd'] = True
+    _, user_id, *report_page = update.callback_query.data.split(':')
+    billing.mark_paid(get_admin_party(update, context), int(user_id))
+    if report_page:
+        kind, page_number = report_page
+        edit_report_page(update, context, kind, int(page_number))
+        return ConversationStatus.ADM_COMMANDS
     text = re.sub(r'не оплачен', r'оплачен',
                   update.callback_query.message.text)
     update.callback_query.edit_message_text(text, reply_markup=None)
     return ConversationStatus.ADM_COMMANDS
 
 
+def digest_done(update, context):
+    logger.debug('Enter digest_done: update=%r', update)
+
+    query = update.callback_query
+    position = int(query.data.split(':')[1])
+    text, reply_markup = digests.mark_done(query.message, position)
+    query.answer()
+    try:
+        query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as error:
+        # Tapped twice before the first edit arrived
+        logger.debug(f'Order digest not updated: {error}')
+
+
 def error_handler(update, context):
     logger.error(msg="Исключение при обработке сообщения:",
                  exc_info=context.error)
@@ -338,89 +598,268 @@ def error_handler(update, context):
 def main():
     load_dotenv(override=True)
     tg_token = os.getenv('TELEGRAM_BOT_TOKEN')
-    admin_chat_id = int(os.getenv('TG_ADMIN_CHAT'))
+    admin_chat_ids = [int(chat_id)
+                      for chat_id in os.getenv('TG_ADMIN_CHAT').split(',')]
     loglevel = os.getenv('LOG_LEVEL', default='INFO')
     logging.basicConfig(level=loglevel,
                         format="%(asctime)s %(levelname)s %(message)s", )
-    logger.addHandler(TelegramLogsHandler(tg_token, admin_chat_id))
+    telegram_api_url = os.getenv('TELEGRAM_API_URL')
+    logger.addHandler(TelegramLogsHandler(tg_token, admin_chat_ids[0],
+                                          base_url=telegram_api_url))
     logger.debug('Start logging')
 
+    webhook_url = os.getenv('WEBHOOK_URL')
+    webhook_listen = os.getenv('WEBHOOK_LISTEN', default='0.0.0.0')
+    webhook_port = int(os.getenv('WEBHOOK_PORT', default='8443'))
+    webhook_path = os.getenv('WEBHOOK_PATH', default='telegram')
+    concurrency = int(os.getenv('UPDATE_CONCURRENCY', default='8'))
+    idle_ttl = int(os.getenv('IDLE_USER_TTL', default='43200'))
+    max_idle_users = int(os.getenv('MAX_IDLE_USERS', default='10000'))
+    digest_window = float(os.getenv('ORDER_DIGEST_WINDOW', default='30'))
+    digest_max_orders = int(os.getenv('ORDER_DIGEST_MAX_ORDERS',
+                                      default='15'))
+    receipt_workers = int(os.getenv('RECEIPT_WORKERS', default='2'))
+    deposit_alerts = [int(threshold) for threshold
+                      in os.getenv('DEPOSIT_ALERTS',
+                                   default='50,80,90,100').split(',')
+                      if threshold.strip()]
+
+    metrics_port = os.getenv('METRICS_PORT')
+    metrics_host = os.getenv('METRICS_HOST', default='127.0.0.1')
+
     redis_host = os.getenv('REDIS_HOST')
     redis_port = os.getenv('REDIS_PORT')
     redis_password = os.getenv('REDIS_PASSWORD')
-
-    redis_storage = redis.Redis(host=redis_host, port=redis_port,
-                                password=redis_password)
+    persistence_layout = os.getenv('PERSISTENCE_LAYOUT', default='sharded')
+    flush_interval = float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', default='0'))
+    flush_threshold = int(os.getenv('PERSISTENCE_FLUSH_THRESHOLD',
+                                    default='100'))
+    compress_threshold = int(os.getenv('PERSISTENCE_COMPRESS_THRESHOLD',
+                                       default='1024'))
+    journal_path = os.getenv('PERSISTENCE_JOURNAL')
+    journal_fsync_interval = float(os.getenv('PERSISTENCE_JOURNAL_FSYNC',
+                                             default='1'))
+
+    # Connections of a dead Redis fail fast instead of holding up handlers
+    redis_pool = redis.BlockingConnectionPool(
+        host=redis_host, port=redis_port, password=redis_password,
+        max_connections=concurrency + 8, socket_connect_timeout=2,
+        socket_timeout=5, retry_on_timeout=True)
+    redis_storage = redis.Redis(connection_pool=redis_pool)
+    journal = None
+    if journal_path and webhook_url:
+        logger.warning('The journal is disabled for shared state.')
+    elif journal_path:
+        journal = Journal(journal_path, fsync_interval=journal_fsync_interval)
     try:
         redis_storage.ping()
-        persistence = RedisPersistence(redis_storage)
-    except redis.ConnectionError:
+        redis_available = True
+    except (redis.ConnectionError, redis.TimeoutError):
+        redis_available = False
+    if redis_available or journal and journal.size:
+        if not redis_available:
+            logger.warning('Redis not available. Run from the journal.')
+        persistence = create_persistence(redis_storage, persistence_layout,
+                                         flush_interval, flush_threshold,
+                                         replicated=bool(webhook_url),
+                                         compress_threshold=compress_threshold,
+                                         journal=journal)
+    else:
         logger.warning('Redis not available. Run without persistence.')
         persistence = False
 
-    updater = Updater(tg_token, persistence=persistence)
-    dispatcher = updater.dispatcher
-
-    dispatcher.bot_data['admin_chat_id'] = admin_chat_id
-    if 'party' not in dispatcher.bot_data:
-        dispatcher.bot_data['party'] = {
-            'date': '09 Марта 2024г.',
-            'place': 'баре Freedom',
-            'status': 'in progress',
-            'guests': {},
-        }
+    # One connection per chat worker, the run_async workers and the updater
+    bot = Bot(tg_token, base_url=telegram_api_url,
+              request=Request(con_pool_size=concurrency + 8))
+    dispatcher = ChatOrderedDispatcher(bot, Queue(), job_queue=JobQueue(),
+                                       persistence=persistence,
+                                       concurrency=concurrency)
+    dispatcher.job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    if persistence:
+        load_seconds = persistence.stats['load_seconds']
+        logger.info(f'Persistence loaded in {load_seconds:.3f}s')
+    if persistence and persistence.write_behind:
+        persistence.start_write_behind(updater.job_queue)
+
+    setup_dispatcher(dispatcher, admin_chat_ids, idle_ttl, max_idle_users,
+                     digest_window, digest_max_orders, receipt_workers,
+                     deposit_alerts)
+
+    if metrics_port:
+        metrics.start_http_server(metrics_host, int(metrics_port),
+                                  persistence or None)
+
+    if webhook_url:
+        updater.start_webhook(listen=webhook_listen, port=webhook_port,
+                              url_path=webhook_path,
+                              webhook_url=f'{webhook_url.rstrip("/")}/'
+                                          f'{webhook_path}')
+    else:
+        updater.start_polling()
+    updater.idle()
+    # The job queue is stopped, the buffered orders are sent right away
+    digests.order_digest.flush_all(bot)
+    if receipts.receipt_matcher:
+        receipts.receipt_matcher.shutdown()
+
+
+def create_persistence(redis_storage, layout, flush_interval=0,
+                       flush_threshold=100, replicated=False,
+                       compress_threshold=1024, journal=None):
+    codec = Codec(compress_threshold=compress_threshold or None)
+    if replicated:
+        if flush_interval > 0:
+            logger.warning('Write-behind is disabled for shared state.')
+        persistence = ShardedRedisPersistence(redis_storage, replicated=True,
+                                              codec=codec)
+    else:
+        persistence_class = RedisPersistence \
+            if layout == 'blob' else ShardedRedisPersistence
+        persistence = persistence_class(redis_storage,
+                                        write_behind=flush_interval > 0,
+                                        flush_interval=flush_interval,
+                                        flush_threshold=flush_threshold,
+                                        codec=codec, journal=journal)
+    metrics.instrument_methods(
+        persistence,
+        ['load_redis', 'flush_dirty', 'flush', 'update_bot_data',
+         'update_user_data', 'update_chat_data', 'update_conversation'],
+        'persistence')
+    return persistence
+
+
+def setup_dispatcher(dispatcher, admin_chat_ids, idle_ttl=0,
+                     max_idle_users=0, digest_window=0, digest_max_orders=0,
+                     receipt_workers=0,
+                     deposit_alerts=deposits.ALERT_THRESHOLDS):
+    bot_data = dispatcher.bot_data
+    # The modules keep the state of the dispatcher set up last, anything
+    # left by a previous one in this process is dropped
+    if receipts.receipt_matcher:
+        receipts.receipt_matcher.shutdown()
+    billing.shared_store = None
+    billing.changed_listener = None
+    deposits.shared_store = None
+    deposits.spent_amounts.clear()
+    analytics.rollups.clear()
+    menu.forget_indexes()
+    deposits.alert_thresholds = deposit_alerts
+    digests.order_digest = digests.OrderDigest(
+        dispatcher.job_queue, digest_window, digest_max_orders)
+    receipts.receipt_matcher = receipts.ReceiptMatcher(
+        dispatcher.bot, receipt_workers) if receipt_workers else None
+    migrated = parties.migrate_bot_data(bot_data, admin_chat_ids[0])
+    for admin_chat_id in admin_chat_ids:
+        if parties.get_admin_party(bot_data, admin_chat_id) is None:
+            # Replicas starting together create the same first party
+            parties.create_party(bot_data, admin_chat_id,
+                                 party_id=str(abs(admin_chat_id)))
+    analytics.store = dispatcher.persistence or None
+    for party in bot_data['parties'].values():
+        billing.rebuild_ledger(party)
+        analytics.load(party)
+    persistence = dispatcher.persistence
+    replicated = getattr(persistence, 'replicated', False)
+    if isinstance(persistence, ShardedRedisPersistence) and not replicated:
+        if migrated:
+            # Before any guest is reported, bot_data writes would leave
+            # the other guests of the migrated party unwritten
+            persistence.write_party(migrated['id'])
+        billing.changed_listener = persistence.mark_guest_changed
+    if replicated:
+        billing.shared_store = persistence
+        persistence.guests_listener = billing.replace_guests
+        persistence.guests_lock = billing.lock
+        deposits.shared_store = persistence
+        for party in bot_data['parties'].values():
+            deposits.seed(party)
+        if migrated:
+            # Shared guests are written only through update_guest
+            for user_id, guest in list(migrated['guests'].items()):
+                billing.update_guest(migrated, user_id,
+                                     lambda current, guest=guest:
+                                     current or guest)
+    if not replicated or persistence.acquire_lock('broadcast_resume', 60):
+        for party in bot_data['parties'].values():
+            broadcast.resume_broadcast(dispatcher.job_queue, party)
+    admin_chats = Filters.chat(admin_chat_ids)
+    # Ordering from the menu works in every step of the free-text order
+    menu_handlers = [
+        CommandHandler('menu', show_menu, ~admin_chats),
+        CallbackQueryHandler(order_menu_item, pattern=r'^menu:\d+:\d+$'),
+        MessageHandler(Filters.text & Filters.via_bot(dispatcher.bot.id)
+                       & ~admin_chats, order_inline_choice),
+    ]
     user_conversation = ConversationHandler(
         entry_points=[
-            MessageHandler(Filters.chat(admin_chat_id), adm_help),
+            MessageHandler(admin_chats, adm_help),
             CommandHandler('start', start),
-            MessageHandler(~Filters.chat(admin_chat_id), help),
+            *menu_handlers,
+            MessageHandler(~admin_chats, help),
         ],
         states={
             ConversationStatus.GET_ITEM: [
+                *menu_handlers,
                 MessageHandler(Filters.text, get_item),
             ],
             ConversationStatus.GET_COST: [
+                *menu_handlers,
                 MessageHandler(Filters.text, get_cost),
             ],
             ConversationStatus.GET_CHECK: [
+                *menu_handlers,
                 MessageHandler(Filters.text('Да'), confirm_choice),
                 MessageHandler(Filters.text('Нет'), decline_choice),
             ],
             ConversationStatus.ADM_COMMANDS: [
-                CommandHandler('total', adm_total,
-                               Filters.chat(admin_chat_id)),
-                CommandHandler('debtors', adm_debtors,
-                               Filters.chat(admin_chat_id)),
-                CommandHandler('sendbills', adm_sendbills,
-                               Filters.chat(admin_chat_id)),
-                CommandHandler('closeparty', adm_close,
-                               Filters.chat(admin_chat_id)),
-                CommandHandler('party', adm_party_info,
-                               Filters.chat(admin_chat_id)),
+                CommandHandler('total', adm_total, admin_chats),
+                CommandHandler('debtors', adm_debtors, admin_chats),
+                CommandHandler('sendbills', adm_sendbills, admin_chats),
+                CommandHandler('closeparty', adm_close, admin_chats),
+                CommandHandler('startparty', adm_start_party, admin_chats),
+                CommandHandler('party', adm_party_info, admin_chats),
+                CommandHandler('stats', adm_stats, admin_chats),
+                CommandHandler('menu', adm_menu, admin_chats),
+                CommandHandler('deposit', adm_deposit, admin_chats),
+                CommandHandler('export', adm_export, admin_chats),
+                CommandHandler('analytics', adm_analytics, admin_chats),
                 CallbackQueryHandler(adm_close, pattern=r'^close_party$'),
                 CallbackQueryHandler(adm_start_party,
                                      pattern=r'^start_party$'),
-                CallbackQueryHandler(adm_send_bill, pattern=r'^sendbill:\d+$'),
-                CallbackQueryHandler(adm_close_bill,
-                                     pattern=r'^closebill:\d+$'),
+                CallbackQueryHandler(
+                    adm_send_bill,
+                    pattern=r'^sendbill:\d+(:(total|debtors):\d+)?$'),
+                CallbackQueryHandler(
+                    adm_close_bill,
+                    pattern=r'^closebill:\d+(:(total|debtors):\d+)?$'),
+                CallbackQueryHandler(adm_report_page,
+                                     pattern=r'^report:(total|debtors):\d+$'),
             ]
         },
         fallbacks=[
-            CommandHandler('stop', help, ~Filters.chat(admin_chat_id)),
+            CommandHandler('stop', help, ~admin_chats),
         ],
         name='party_billing_conversation',
-        persistent=persistence,
+        persistent=bool(dispatcher.persistence),
     )
+    metrics.instrument_conversation(user_conversation)
     dispatcher.add_handler(user_conversation)
+    dispatcher.add_handler(InlineQueryHandler(
+        metrics.instrument(inline_menu, 'handler.inline_menu')))
+    # Waiters mark the orders served without talking to the bot first
+    dispatcher.add_handler(CallbackQueryHandler(
+        metrics.instrument(digest_done, 'handler.digest_done'),
+        pattern=r'^digest_done:\d+$'))
     dispatcher.add_handler(
-        MessageHandler(~Filters.chat(admin_chat_id) & Filters.document,
-                       forward_document)
+        MessageHandler(~admin_chats & Filters.document, forward_document)
     )
 
     dispatcher.add_error_handler(error_handler)
-
-    updater.start_polling()
-    updater.idle()
+    if idle_ttl or max_idle_users:
+        return eviction.schedule(dispatcher, [user_conversation],
+                                 idle_ttl or None, max_idle_users or None)
+    return None
 
 
 if __name__ == '__main__':
@@ -1,31 +1,174 @@
 # https://github.com/Mortafix/RedisPersistence/commit/a7bdadeb52e4a3e3061adc8c60e35819a543119e
-import pickle
+import logging
+import time
 from collections import defaultdict
-from copy import deepcopy
-from typing import Any, DefaultDict, Dict, Optional, Tuple
+from threading import Lock, RLock, Thread
+from typing import Any, Callable, DefaultDict, Dict, Iterable, List, Optional, Set, Tuple
 from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError, WatchError
 
 from telegram.ext import BasePersistence
 from telegram.ext.utils.types import ConversationDict
 
+from codec import Codec
+from journal import Journal
+
+
+logger = logging.getLogger(__file__)
+
+REDIS_UNAVAILABLE = (RedisConnectionError, RedisTimeoutError)
 
 class RedisPersistence(BasePersistence):
 	'''Using Redis to make the bot persistent'''
 
-	def __init__(self,redis: Redis,on_flush: bool = False):
+	def __init__(self,redis: Redis,on_flush: bool = False,write_behind: bool = False,
+			flush_interval: float = 5.0,flush_threshold: int = 100,codec: Optional[Codec] = None,
+			journal: Optional[Journal] = None,retry_interval: float = 1.0,max_retry_interval: float = 30.0):
 		super().__init__(store_user_data=True,store_chat_data=True,store_bot_data=True)
 		self.redis: Redis = redis
+		self.codec: Codec = codec or Codec()
+		self.journal = journal
+		self.retry_interval = retry_interval
+		self.max_retry_interval = max_retry_interval
 		self.on_flush = on_flush
+		self.write_behind = write_behind
+		self.flush_interval = flush_interval
+		self.flush_threshold = flush_threshold
 		self.user_data: Optional[DefaultDict[int, Dict]] = None
 		self.chat_data: Optional[DefaultDict[int, Dict]] = None
 		self.bot_data: Optional[Dict] = None
 		self.conversations: Optional[Dict[str, Dict[Tuple, Any]]] = None
+		self.stats: Dict[str, float] = {
+			'flushes': 0,
+			'entries_written': 0,
+			'bytes_written': 0,
+			'flush_seconds': 0.0,
+			'max_flush_seconds': 0.0,
+			'load_seconds': 0.0,
+			'offline': 0,
+			'journal_pending': 0,
+			'replayed_records': 0,
+			'reconnects': 0,
+		}
+		# (section, key) pairs changed since the last write, see :meth:`flush_dirty`
+		self._dirty: Set[Tuple[str, Any]] = set()
+		# Sales rollup counters per party id as reported and as last written, see :meth:`update_analytics`
+		self.analytics: Dict[str, Dict[str, int]] = {}
+		self._written_analytics: DefaultDict[str, Dict[str, int]] = defaultdict(dict)
+		self._lock = RLock()
+		self._flush_lock = Lock()
+		self._job_queue = None
+		self._flush_scheduled = False
+		self._loaded = False
+		# Where the state is loaded from: the journal if Redis is down at startup
+		self._source = redis
+		self._online = True
+		self._send_lock = RLock()
+
+	def _ensure_loaded(self, section: str) -> None:
+		'''Loads the state from Redis on first access. The single-key layout loads all sections at once.'''
+		if self._loaded:
+			return
+		with self._lock:
+			if self._loaded:
+				return
+			started = time.perf_counter()
+			self._open()
+			self.load_redis()
+			self._loaded = True
+			self._seed_journal()
+			self.stats['load_seconds'] += time.perf_counter() - started
+
+	def _open(self) -> None:
+		'''Replays the journal left by the previous run. If Redis is down, the state is loaded from the
+		journal instead and Redis gets it once it is back.'''
+		if self.journal is None or not self.journal.pending:
+			return
+		try:
+			self._replay()
+		except REDIS_UNAVAILABLE:
+			self._source = self.journal.snapshot()
+			self._go_offline()
+
+	def _seed_journal(self) -> None:
+		'''Starts an empty journal with the loaded state, so that it alone is enough to start from.'''
+		if self.journal is not None and not self.journal.size:
+			self.journal.append(self._state_commands())
+			self.journal.acknowledge()
+
+	@staticmethod
+	def _pipeline_of(redis: Redis, commands: List[Tuple]) -> Any:
+		pipe = redis.pipeline()
+		for name, *args in commands:
+			getattr(pipe, name)(*args)
+		return pipe
+
+	def _send(self, commands: List[Tuple]) -> None:
+		'''Sends the commands to Redis in one pipeline. With a journal they are appended to it first,
+		and while Redis is unreachable only appended: handlers go on and the reconnect thread sends
+		them once Redis is back.'''
+		with self._send_lock:
+			if self.journal is None:
+				self._pipeline_of(self.redis, commands).execute()
+				return
+			self.journal.append(commands)
+			if self._online:
+				try:
+					self._pipeline_of(self.redis, commands).execute()
+				except REDIS_UNAVAILABLE:
+					self._go_offline()
+				else:
+					self.journal.acknowledge()
+			self.stats['journal_pending'] = self.journal.pending
+
+	def _go_offline(self) -> None:
+		self._online = False
+		self.stats['offline'] = 1
+		self.stats['journal_pending'] = self.journal.pending
+		logger.warning(f'Redis not available, changes are kept in {self.journal.path} until it is back')
+		Thread(target=self._reconnect, name='PersistenceReconnect', daemon=True).start()
+
+	def _reconnect(self) -> None:
+		'''Pings Redis with a growing interval and replays the whole journal once it answers, which also
+		restores the state if Redis was restarted without its data.'''
+		delay = self.retry_interval
+		while True:
+			time.sleep(delay)
+			try:
+				self.redis.ping()
+				with self._send_lock:
+					replayed = self.journal.pending
+					self._replay(everything=True)
+					self._online = True
+					self._source = self.redis
+			except REDIS_UNAVAILABLE:
+				delay = min(delay * 2, self.max_retry_interval)
+				continue
+			self.stats['offline'] = 0
+			self.stats['reconnects'] += 1
+			logger.warning(f'Redis is back, {replayed} journal records replayed')
+			return
+
+	def _replay(self, everything: bool = False, batch_size: int = 1000) -> None:
+		'''Sends the pending (or all) journal records to Redis, in pipelines of about ``batch_size``
+		commands. The commands only set or delete values, so records already in Redis can be sent again.'''
+		commands: List[Tuple] = []
+		for record in self.journal.pending_records(everything):
+			commands.extend(record)
+			if len(commands) >= batch_size:
+				self._pipeline_of(self.redis, commands).execute()
+				commands = []
+		if commands:
+			self._pipeline_of(self.redis, commands).execute()
+		self.stats['replayed_records'] += self.journal.pending
+		self.stats['journal_pending'] = 0
+		self.journal.acknowledge()
 
 	def load_redis(self) -> None:
 		try:
-			data_bytes = self.redis.get('TelegramBotPersistence')
+			data_bytes = self._source.get('TelegramBotPersistence')
 			if data_bytes:
-				data = pickle.loads(data_bytes)
+				data = self.codec.decode(data_bytes)
 				self.user_data = defaultdict(dict, data['user_data'])
 				self.chat_data = defaultdict(dict, data['chat_data'])
 				# For backwards compatibility with files not containing bot data
@@ -37,88 +180,794 @@ class RedisPersistence(BasePersistence):
 				self.chat_data = defaultdict(dict)
 				self.bot_data = {}
 		except Exception as exc:
-			raise TypeError(f"Something went wrong unpickling from Redis") from exc
-
-	def dump_redis(self) -> None:
-		data = {
-			'conversations': self.conversations,
-			'user_data': self.user_data,
-			'chat_data': self.chat_data,
-			'bot_data': self.bot_data,
-		}
-		data_bytes = pickle.dumps(data)
-		self.redis.set('TelegramBotPersistence',data_bytes)
+			raise TypeError(f"Something went wrong decoding from Redis") from exc
+
+	def _state_commands(self) -> List[Tuple]:
+		'''Returns the commands writing the whole state.'''
+		with self._lock:
+			data = {
+				'conversations': self.conversations,
+				'user_data': self.user_data,
+				'chat_data': self.chat_data,
+				'bot_data': self.bot_data,
+			}
+			return [('set', 'TelegramBotPersistence', self.codec.encode(data))]
+
+	def dump_redis(self) -> int:
+		with self._lock:
+			changes = self._analytics_changes(list(self.analytics))
+		commands = self._state_commands()
+		self._send(commands + self._analytics_commands(changes))
+		self._analytics_written(changes)
+		return len(commands[0][2])
+
+	def _write_dirty(self, dirty: Iterable[Tuple[str, Any]]) -> int:
+		'''Writes the dirty entries to Redis and returns the number of bytes sent.
+		The single-key layout can only write the whole state.'''
+		return self.dump_redis()
+
+	def _mark_dirty(self, section: str, key: Any = None) -> None:
+		'''Records a changed entry and writes it now, on the next write-behind flush or on :meth:`flush`.'''
+		with self._lock:
+			self._dirty.add((section, key))
+			dirty_count = len(self._dirty)
+		if self.on_flush:
+			return
+		if not self.write_behind:
+			self.flush_dirty()
+		elif dirty_count >= self.flush_threshold and self._job_queue and not self._flush_scheduled:
+			self._flush_scheduled = True
+			self._job_queue.run_once(self._flush_job, 0, name='persistence_flush')
+
+	def start_write_behind(self, job_queue) -> None:
+		'''Flushes dirty entries from the job queue every :attr:`flush_interval` seconds.'''
+		self._job_queue = job_queue
+		job_queue.run_repeating(self._flush_job, interval=self.flush_interval,
+			first=self.flush_interval, name='persistence_flush')
+
+	def _flush_job(self, context) -> None:
+		self._flush_scheduled = False
+		self.flush_dirty()
 
+	def flush_dirty(self) -> None:
+		'''Writes all entries changed since the last write in a single Redis round-trip.'''
+		with self._flush_lock:
+			with self._lock:
+				dirty, self._dirty = self._dirty, set()
+			if not dirty:
+				return
+			started = time.perf_counter()
+			try:
+				bytes_written = self._write_dirty(dirty)
+			except Exception:
+				with self._lock:
+					self._dirty |= dirty
+				raise
+			self._record_flush(len(dirty), bytes_written, time.perf_counter() - started)
+
+	def _record_flush(self, entries: int, bytes_written: int, seconds: float) -> None:
+		self.stats['flushes'] += 1
+		self.stats['entries_written'] += entries
+		self.stats['bytes_written'] += bytes_written
+		self.stats['flush_seconds'] += seconds
+		self.stats['max_flush_seconds'] = max(self.stats['max_flush_seconds'], seconds)
+
+	# The get_* methods don't copy the data: BasePersistence already passes it through insert_bot,
+	# which hands the dispatcher its own copy.
 	def get_user_data(self) -> DefaultDict[int, Dict[Any, Any]]:
 		'''Returns the user_data from the pickle on Redis if it exists or an empty :obj:`defaultdict`.'''
-		if self.user_data:
-			pass
-		else:
-			self.load_redis()
-		return deepcopy(self.user_data)  # type: ignore[arg-type]
+		self._ensure_loaded('user_data')
+		return self.user_data  # type: ignore[return-value]
 
 	def get_chat_data(self) -> DefaultDict[int, Dict[Any, Any]]:
 		'''Returns the chat_data from the pickle on Redis if it exists or an empty :obj:`defaultdict`.'''
-		if self.chat_data:
-			pass
-		else:
-			self.load_redis()
-		return deepcopy(self.chat_data)  # type: ignore[arg-type]
+		self._ensure_loaded('chat_data')
+		return self.chat_data  # type: ignore[return-value]
 
 	def get_bot_data(self) -> Dict[Any, Any]:
 		'''Returns the bot_data from the pickle on Redis if it exists or an empty :obj:`dict`.'''
-		if self.bot_data:
-			pass
-		else:
-			self.load_redis()
-		return deepcopy(self.bot_data)  # type: ignore[arg-type]
+		self._ensure_loaded('bot_data')
+		return self.bot_data  # type: ignore[return-value]
 
 	def get_conversations(self, name: str) -> ConversationDict:
 		'''Returns the conversations from the pickle on Redis if it exsists or an empty dict.'''
-		if self.conversations:
-			pass
-		else:
-			self.load_redis()
+		self._ensure_loaded('conversations')
 		return self.conversations.get(name, {}).copy()  # type: ignore[union-attr]
 
 	def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
 		'''Will update the conversations for the given handler and depending on :attr:`on_flush` save the pickle on Redis.'''
-		if not self.conversations:
-			self.conversations = dict()
-		if self.conversations.setdefault(name, {}).get(key) == new_state:
-			return
-		self.conversations[name][key] = new_state
-		if not self.on_flush:
-			self.dump_redis()
+		with self._lock:
+			if not self.conversations:
+				self.conversations = dict()
+			if self.conversations.setdefault(name, {}).get(key) == new_state:
+				return
+			if new_state is None:
+				del self.conversations[name][key]
+			else:
+				self.conversations[name][key] = new_state
+		self._mark_dirty('conversations', (name, key))
 
 	def update_user_data(self, user_id: int, data: Dict) -> None:
 		'''Will update the user_data and depending on :attr:`on_flush` save the pickle on Redis.'''
-		if self.user_data is None:
-			self.user_data = defaultdict(dict)
-		if self.user_data.get(user_id) == data:
-			return
-		self.user_data[user_id] = data
-		if not self.on_flush:
-			self.dump_redis()
+		with self._lock:
+			if self.user_data is None:
+				self.user_data = defaultdict(dict)
+			if self.user_data.get(user_id) == data:
+				return
+			self.user_data[user_id] = data
+		self._mark_dirty('user_data', user_id)
+
+	def drop_user_data(self, user_id: int) -> None:
+		'''Removes the user_data of the user and depending on :attr:`on_flush` from Redis.'''
+		with self._lock:
+			if self.user_data is None or self.user_data.pop(user_id, None) is None:
+				return
+		self._mark_dirty('user_data', user_id)
 
 	def update_chat_data(self, chat_id: int, data: Dict) -> None:
 		'''Will update the chat_data and depending on :attr:`on_flush` save the pickle on Redis.'''
-		if self.chat_data is None:
-			self.chat_data = defaultdict(dict)
-		if self.chat_data.get(chat_id) == data:
-			return
-		self.chat_data[chat_id] = data
-		if not self.on_flush:
-			self.dump_redis()
+		with self._lock:
+			if self.chat_data is None:
+				self.chat_data = defaultdict(dict)
+			if self.chat_data.get(chat_id) == data:
+				return
+			self.chat_data[chat_id] = data
+		self._mark_dirty('chat_data', chat_id)
 
 	def update_bot_data(self, data: Dict) -> None:
 		'''Will update the bot_data and depending on :attr:`on_flush` save the pickle on Redis.'''
-		if self.bot_data == data:
-			return
-		self.bot_data = data.copy()
-		if not self.on_flush:
-			self.dump_redis()
+		with self._lock:
+			if self.bot_data == data:
+				return
+			self.bot_data = data.copy()
+		self._mark_dirty('bot_data')
+
+	def archive_party(self, party: Dict) -> None:
+		'''Stores a finished party under its own key, the state itself keeps only the active parties.'''
+		with self._lock:
+			self._forget_analytics(party['id'])
+		self._send([
+			('set', f'TelegramBotPersistence:archive:{party["id"]}', self.codec.encode(party)),
+			('delete', self._analytics_key(party['id'])),
+		])
+
+	def load_archived_party(self, party_id: str) -> Optional[Dict]:
+		'''Reads a party stored by :meth:`archive_party`, None if there is no such party.'''
+		data = self.redis.get(f'TelegramBotPersistence:archive:{party_id}')
+		return self.codec.decode(data) if data else None
+
+	def _analytics_key(self, party_id: str) -> str:
+		return f'TelegramBotPersistence:party:{party_id}:analytics'
+
+	def load_analytics(self, party_id: str) -> Dict[str, int]:
+		'''Reads the sales rollup counters of the party, see the analytics module.'''
+		raw = self._source.hgetall(self._analytics_key(party_id))
+		return {field.decode(): int(value) for field, value in raw.items()}
+
+	def update_analytics(self, party_id: str, values: Dict[str, int]) -> None:
+		'''Records the current values of the given rollup counters and depending on :attr:`on_flush`
+		saves them on Redis. The counters only grow, so of two reports the larger value is the newer.'''
+		with self._lock:
+			counters = self.analytics.setdefault(party_id, {})
+			for field, value in values.items():
+				counters[field] = max(counters.get(field, 0), value)
+		self._mark_dirty('analytics', party_id)
+
+	def _analytics_changes(self, party_ids: Iterable[str]) -> List[Tuple[str, str, int]]:
+		'''Returns the counters of the parties changed since they were last written, under the lock.'''
+		changes = []
+		for party_id in party_ids:
+			written = self._written_analytics[party_id]
+			changes += [(party_id, field, value) for field, value in self.analytics.get(party_id, {}).items()
+				if written.get(field) != value]
+		return changes
+
+	def _analytics_commands(self, changes: List[Tuple[str, str, int]]) -> List[Tuple]:
+		# Plain values, not pickles, so replicas can add to them with HINCRBY
+		return [('hset', self._analytics_key(party_id), field, value) for party_id, field, value in changes]
+
+	def _analytics_written(self, changes: List[Tuple[str, str, int]]) -> None:
+		with self._lock:
+			for party_id, field, value in changes:
+				if party_id in self.analytics:
+					self._written_analytics[party_id][field] = value
+
+	def _forget_analytics(self, party_id: str) -> None:
+		self.analytics.pop(party_id, None)
+		self._written_analytics.pop(party_id, None)
+
+	def increment_analytics(self, party_id: str, increments: Dict[str, int]) -> None:
+		'''Adds to the rollup counters shared by replicas.'''
+		key = self._analytics_key(party_id)
+		pipe = self.redis.pipeline()
+		for field, value in increments.items():
+			pipe.hincrby(key, field, value)
+		pipe.execute()
 
 	def flush(self) -> None:
 		'''Will save all data in memory to pickle on Redis.'''
-		self.dump_redis()
+		with self._flush_lock:
+			with self._lock:
+				self._dirty.clear()
+			started = time.perf_counter()
+			bytes_written = self.dump_redis()
+			self._record_flush(0, bytes_written, time.perf_counter() - started)
+		if self.journal is not None:
+			self.journal.sync()
+
+
+class RedisConversations(dict):
+	'''Conversation states of one handler read from Redis on every lookup,
+	so that replicas see the states set by each other.'''
+
+	def __init__(self, persistence: 'ShardedRedisPersistence', name: str):
+		super().__init__()
+		self.persistence = persistence
+		self.name = name
+
+	def get(self, key, default=None):
+		state = self.persistence.read_conversation(self.name, key)
+		return default if state is None else state
+
+	def __getitem__(self, key):
+		state = self.get(key)
+		if state is None:
+			raise KeyError(key)
+		return state
+
+	def __contains__(self, key) -> bool:
+		return self.get(key) is not None
+
+	# Changes reach Redis through update_conversation, nothing is kept locally
+	def __setitem__(self, key, value) -> None:
+		pass
+
+	def __delitem__(self, key) -> None:
+		pass
+
+
+class ShardedRedisPersistence(RedisPersistence):
+	'''Keeps every user, chat, conversation entry, party and party guest under its own Redis hash
+	field, so an update writes only the entry that changed instead of the whole state. Each party
+	has its own guests hash, finished parties are moved to ``archive:<party id>`` keys.
+
+	With ``replicated`` several bot processes can share the same keys: conversations, user_data and
+	party guests are re-read from Redis before they are used and guests are changed only through
+	:meth:`update_guest`, which never overwrites a concurrent change.'''
+
+	BLOB_KEY = 'TelegramBotPersistence'
+	SECTIONS = ('user_data', 'chat_data', 'conversations', 'bot_data')
+	# Compare-and-set of a guest record, bumps the state version on success
+	GUEST_CAS = """
+		local current = redis.call('HGET', KEYS[1], ARGV[1])
+		if (current or '') ~= ARGV[2] then
+			return 0
+		end
+		redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+		local version = redis.call('INCR', KEYS[3])
+		redis.call('HSET', KEYS[2], ARGV[1], version)
+		return version
+	"""
+	# Adds to the deposit counter of a party unless it would go over the limit (a negative limit is no
+	# limit), returns whether it was added and the counter
+	DEPOSIT_RESERVE = """
+		local spent = tonumber(redis.call('GET', KEYS[1]) or '0')
+		local amount = tonumber(ARGV[1])
+		local limit = tonumber(ARGV[2])
+		if limit >= 0 and spent + amount > limit then
+			return {0, spent}
+		end
+		return {1, redis.call('INCRBY', KEYS[1], amount)}
+	"""
+
+	def __init__(self, redis: Redis, on_flush: bool = False, write_behind: bool = False,
+			flush_interval: float = 5.0, flush_threshold: int = 100, prefix: str = 'TelegramBotPersistence',
+			replicated: bool = False, max_retries: int = 10, codec: Optional[Codec] = None,
+			journal: Optional[Journal] = None, retry_interval: float = 1.0, max_retry_interval: float = 30.0):
+		if replicated and (write_behind or on_flush):
+			raise ValueError('Replicated persistence has to write every change immediately')
+		if replicated and journal is not None:
+			raise ValueError('Replicated persistence has to read the changes of other replicas from Redis')
+		super().__init__(redis, on_flush=on_flush, write_behind=write_behind,
+			flush_interval=flush_interval, flush_threshold=flush_threshold, codec=codec,
+			journal=journal, retry_interval=retry_interval, max_retry_interval=max_retry_interval)
+		self.prefix = prefix
+		self.replicated = replicated
+		self.max_retries = max_retries
+		# Called with bot_data and {party_id: {user_id: record}} to store guests changed by other
+		# replicas, under guests_lock, the lock of the code changing guests locally, also held to apply
+		# the records written by update_guest
+		self.guests_listener: Optional[Callable[[Dict, Dict], None]] = None
+		self.guests_lock = RLock()
+		# Bytes last written to (or read from) Redis per section and field, used to skip unchanged entries
+		self._written: DefaultDict[str, Dict[str, bytes]] = defaultdict(dict)
+		self._loaded_sections: Set[str] = set()
+		self._version: Optional[bytes] = None
+		self._guest_versions: DefaultDict[str, Dict[str, int]] = defaultdict(dict)
+		# Set once guests are reported by mark_guest_changed, bot_data writes then skip the guests
+		self._guests_tracked = False
+		self._guest_cas = redis.register_script(self.GUEST_CAS) if replicated else None
+		self._deposit_reserve = redis.register_script(self.DEPOSIT_RESERVE) if replicated else None
+
+	# The stored state holds no Bot instances, so the copying replace_bot/insert_bot pass of
+	# BasePersistence is skipped: the dispatcher and the persistence share the same objects and
+	# changes are detected per entry by comparing the pickled bytes with the ones last written.
+	@classmethod
+	def replace_bot(cls, obj: object) -> object:
+		return obj
+
+	def insert_bot(self, obj: object) -> object:
+		return obj
+
+	def _key(self, section: str) -> str:
+		return f'{self.prefix}:{section}'
+
+	@staticmethod
+	def _guests_section(party_id: str) -> str:
+		return f'party:{party_id}:guests'
+
+	@staticmethod
+	def _versions_section(party_id: str) -> str:
+		return f'party:{party_id}:guest_versions'
+
+	@staticmethod
+	def _deposit_section(party_id: str) -> str:
+		return f'party:{party_id}:deposit_spent'
+
+	def _analytics_key(self, party_id: str) -> str:
+		return self._key(f'party:{party_id}:analytics')
+
+	@staticmethod
+	def _conversation_field(name: str, key: Tuple[int, ...]) -> str:
+		return f'{name}:' + ','.join(str(part) for part in key)
+
+	@staticmethod
+	def _parse_conversation_field(field: str) -> Tuple[str, Tuple[int, ...]]:
+		name, _, key = field.rpartition(':')
+		return name, tuple(int(part) for part in key.split(',') if part)
+
+	@staticmethod
+	def _split_bot_data(data: Dict) -> Tuple[Dict, Dict[str, Dict], Dict[str, Dict]]:
+		'''Separates the parties and their guests from the rest of bot_data. The billing ledger is
+		left out altogether, it is rebuilt from the guests on startup.'''
+		bot_data = dict(data)
+		parties, guests = {}, {}
+		for party_id, party in list((bot_data.pop('parties', None) or {}).items()):
+			party = dict(party)
+			party.pop('ledger', None)
+			guests[party_id] = party.pop('guests', {})
+			parties[party_id] = party
+		return bot_data, parties, guests
+
+	def _ensure_loaded(self, section: str) -> None:
+		'''Fetches and decodes only the requested section, once, on its first access.'''
+		if section in self._loaded_sections:
+			return
+		with self._lock:
+			if section in self._loaded_sections:
+				return
+			started = time.perf_counter()
+			if not self._loaded:
+				self._loaded = True
+				self._open()
+				if not self._source.exists(self._key('bot_data')) and self._source.exists(self.BLOB_KEY):
+					self._migrate_blob()
+					self._loaded_sections.update(self.SECTIONS)
+			if section not in self._loaded_sections:
+				self._load_section(section)
+				self._loaded_sections.add(section)
+				if self._loaded_sections.issuperset(self.SECTIONS):
+					self._seed_journal()
+			self.stats['load_seconds'] += time.perf_counter() - started
+
+	def _load_section(self, section: str) -> None:
+		try:
+			if section == 'bot_data':
+				pipe = self._source.pipeline()
+				pipe.get(self._key('bot_data'))
+				pipe.hgetall(self._key('parties'))
+				pipe.get(self._key('version'))
+				bot_raw, parties_raw, self._version = pipe.execute()
+				self.bot_data = self.codec.decode(bot_raw) if bot_raw else {}
+				if bot_raw:
+					self._written['bot_data'][''] = bot_raw
+				parties = self._decode_hash('parties', parties_raw, str)
+				if parties:
+					self.bot_data['parties'] = parties
+				pipe = self._source.pipeline()
+				for party_id in parties:
+					pipe.hgetall(self._key(self._guests_section(party_id)))
+					pipe.hgetall(self._key(self._versions_section(party_id)))
+				results = pipe.execute()
+				for index, (party_id, party) in enumerate(parties.items()):
+					guests_raw, versions_raw = results[2 * index:2 * index + 2]
+					party['guests'] = self._decode_hash(self._guests_section(party_id), guests_raw, int)
+					self._guest_versions[party_id] = {field.decode(): int(version) for field, version in versions_raw.items()}
+				if isinstance(self.bot_data.get('party'), dict):
+					# The single party of older versions, its guests were kept in one hash
+					guests_raw = self._source.hgetall(self._key('guests'))
+					self.bot_data['party']['guests'] = self._decode_hash('guests', guests_raw, int)
+			elif section == 'conversations':
+				raw = self._source.hgetall(self._key(section))
+				self.conversations = dict()
+				for field, state in self._decode_hash(section, raw, str).items():
+					name, key = self._parse_conversation_field(field)
+					self.conversations.setdefault(name, {})[key] = state
+			else:
+				raw = self._source.hgetall(self._key(section))
+				setattr(self, section, defaultdict(dict, self._decode_hash(section, raw, int)))
+		except Exception as exc:
+			raise TypeError(f"Something went wrong decoding {section} from Redis") from exc
+
+	def load_redis(self) -> None:
+		for section in self.SECTIONS:
+			self._ensure_loaded(section)
+
+	def _decode_hash(self, section: str, raw: Dict[bytes, bytes], key_type: type) -> Dict:
+		decoded = {}
+		for field, value in raw.items():
+			field = field.decode()
+			self._written[section][field] = value
+			decoded[key_type(field)] = self.codec.decode(value)
+		return decoded
+
+	def _migrate_blob(self) -> None:
+		'''Converts the single pickled state written by :class:`RedisPersistence` to the sharded layout.
+		The old key is kept under a ``:migrated`` suffix as a backup.'''
+		blob = self._source.get(self.BLOB_KEY)
+		super().load_redis()
+		writes: List = []
+		with self._lock:
+			self._stage_all(writes, with_guests=True)
+		self._execute(writes)
+		self._send([('set', f'{self.BLOB_KEY}:migrated', blob), ('delete', self.BLOB_KEY)])
+
+	def _stage_field(self, writes: List, section: str, field: str, value: Optional[object]) -> None:
+		'''Queues a write of a single hash field if its content changed.'''
+		written = self._written[section].get(field)
+		if value is None:
+			if written is not None:
+				writes.append((section, field, None))
+			return
+		data_bytes = self.codec.encode(value)
+		if data_bytes != written:
+			writes.append((section, field, data_bytes))
+
+	def _stage_hash(self, writes: List, section: str, entries: Dict[str, object]) -> None:
+		'''Queues writes for the changed fields of a whole section and removal of the stale ones.'''
+		for field, value in entries.items():
+			self._stage_field(writes, section, field, value)
+		for field in self._written[section]:
+			if field not in entries:
+				writes.append((section, field, None))
+
+	def _stage_bot_data(self, writes: List, with_guests: bool) -> None:
+		bot_data, parties, guests = self._split_bot_data(self.bot_data or {})
+		data_bytes = self.codec.encode(bot_data)
+		if data_bytes != self._written['bot_data'].get(''):
+			writes.append(('bot_data', '', data_bytes))
+		for party_id, party in parties.items():
+			self._stage_field(writes, 'parties', party_id, party)
+		if with_guests:
+			for party_id, party_guests in guests.items():
+				self._stage_hash(writes, self._guests_section(party_id),
+					{str(user_id): guest for user_id, guest in list(party_guests.items())})
+
+	def _execute(self, writes: List, analytics: Optional[List[Tuple[str, str, int]]] = None) -> int:
+		'''Sends the queued writes and changed rollup counters through one pipeline and returns the
+		number of bytes sent.'''
+		if not writes and not analytics:
+			return 0
+		commands: List[Tuple] = self._analytics_commands(analytics or [])
+		for section, field, data_bytes in writes:
+			if section == 'bot_data':
+				commands.append(('set', self._key(section), data_bytes))
+			elif data_bytes is None:
+				commands.append(('hdel', self._key(section), field))
+			else:
+				commands.append(('hset', self._key(section), field, data_bytes))
+		if self.replicated and any(section not in ('user_data', 'chat_data', 'conversations') for section, _, _ in writes):
+			commands.append(('incr', self._key('version')))
+		self._send(commands)
+		for section, field, data_bytes in writes:
+			if data_bytes is None:
+				self._written[section].pop(field, None)
+			else:
+				self._written[section][field] = data_bytes
+		self._analytics_written(analytics or [])
+		return sum(len(data_bytes) for _, _, data_bytes in writes if data_bytes)
+
+	def _write_dirty(self, dirty: Iterable[Tuple[str, Any]]) -> int:
+		writes: List = []
+		with self._lock:
+			analytics = self._analytics_changes(key for section, key in dirty if section == 'analytics')
+			for section, key in dirty:
+				if section == 'analytics':
+					continue
+				if section == 'bot_data':
+					self._stage_bot_data(writes, with_guests=not self.replicated and not self._guests_tracked)
+				elif section == 'guests':
+					party_id, user_id = key
+					party = (self.bot_data or {}).get('parties', {}).get(party_id)
+					# Nothing to write for a party archived meanwhile
+					if party is not None:
+						self._stage_field(writes, self._guests_section(party_id), str(user_id),
+							party['guests'].get(user_id))
+				elif section == 'conversations':
+					name, conversation_key = key
+					state = self.conversations.get(name, {}).get(conversation_key)
+					self._stage_field(writes, section, self._conversation_field(name, conversation_key), state)
+				else:
+					self._stage_field(writes, section, str(key), getattr(self, section).get(key))
+		return self._execute(writes, analytics)
+
+	def _stage_all(self, writes: List, with_guests: bool) -> None:
+		self._stage_hash(writes, 'user_data', {str(user_id): data for user_id, data in list((self.user_data or {}).items())})
+		self._stage_hash(writes, 'chat_data', {str(chat_id): data for chat_id, data in list((self.chat_data or {}).items())})
+		self._stage_hash(writes, 'conversations', {
+			self._conversation_field(name, key): state
+			for name, states in (self.conversations or {}).items()
+			for key, state in states.items()
+			if state is not None
+		})
+		self._stage_bot_data(writes, with_guests)
+
+	def dump_redis(self) -> int:
+		writes: List = []
+		with self._lock:
+			self._stage_all(writes, with_guests=not self.replicated)
+			analytics = self._analytics_changes(list(self.analytics))
+		return self._execute(writes, analytics)
+
+	def _state_commands(self) -> List[Tuple]:
+		'''Returns the commands writing all entries as last written to (or read from) Redis.'''
+		commands: List[Tuple] = []
+		with self._lock:
+			for section, fields in self._written.items():
+				for field, data_bytes in fields.items():
+					if section == 'bot_data':
+						commands.append(('set', self._key(section), data_bytes))
+					else:
+						commands.append(('hset', self._key(section), field, data_bytes))
+		return commands
+
+	def _unchanged(self, section: str, field: str, value: object) -> bool:
+		'''Whether the entry is the same as last written. The dispatcher hands over the stored objects
+		themselves, changed in place, so they are compared by their pickled bytes.'''
+		return self.codec.encode(value) == self._written[section].get(field)
+
+	def update_user_data(self, user_id: int, data: Dict) -> None:
+		'''Will update the user_data and depending on :attr:`on_flush` save it on Redis if it changed.'''
+		with self._lock:
+			if self.user_data is None:
+				self.user_data = defaultdict(dict)
+			self.user_data[user_id] = data
+			if self._unchanged('user_data', str(user_id), data):
+				return
+		self._mark_dirty('user_data', user_id)
+
+	def update_chat_data(self, chat_id: int, data: Dict) -> None:
+		'''Will update the chat_data and depending on :attr:`on_flush` save it on Redis if it changed.'''
+		with self._lock:
+			if self.chat_data is None:
+				self.chat_data = defaultdict(dict)
+			self.chat_data[chat_id] = data
+			if self._unchanged('chat_data', str(chat_id), data):
+				return
+		self._mark_dirty('chat_data', chat_id)
+
+	def update_bot_data(self, data: Dict) -> None:
+		'''Will update the bot_data and depending on :attr:`on_flush` save the changed guests on Redis.'''
+		with self._lock:
+			self.bot_data = data
+		self._mark_dirty('bot_data')
+
+	def write_party(self, party_id: str) -> int:
+		'''Writes bot_data together with all guests of the party now. Used for a party moved out of the
+		legacy layout on startup: its guests were never written to their own hash, and once guests are
+		reported by :meth:`mark_guest_changed` the bot_data writes no longer compare them.'''
+		writes: List = []
+		with self._lock:
+			self._stage_bot_data(writes, with_guests=False)
+			party = (self.bot_data or {}).get('parties', {}).get(party_id)
+			if party is not None:
+				self._stage_hash(writes, self._guests_section(party_id),
+					{str(user_id): guest for user_id, guest in list(party['guests'].items())})
+		return self._execute(writes)
+
+	def mark_guest_changed(self, party_id: str, user_id: int) -> None:
+		'''Records a changed party guest. Once guests are reported this way, bot_data writes don't
+		compare all guests of every party with the ones written, only the reported guests are written.'''
+		self._guests_tracked = True
+		self._mark_dirty('guests', (party_id, user_id))
+
+	def drop_user_data(self, user_id: int) -> None:
+		'''Removes the user_data of the user and depending on :attr:`on_flush` from Redis.'''
+		with self._lock:
+			if self.user_data is not None:
+				self.user_data.pop(user_id, None)
+		self._mark_dirty('user_data', user_id)
+
+	def forget_user(self, user_id: int, conversation_keys: Iterable[Tuple[int, ...]]) -> None:
+		'''Drops the cached user_data and conversation states of the user but keeps them in Redis, where
+		other replicas may still use them. They are read again when the user comes back.'''
+		with self._lock:
+			if self.user_data is not None:
+				self.user_data.pop(user_id, None)
+			self._written['user_data'].pop(str(user_id), None)
+			for name, states in (self.conversations or {}).items():
+				for key in conversation_keys:
+					if states.pop(key, None) is not None:
+						self._written['conversations'].pop(self._conversation_field(name, key), None)
+
+	def get_conversations(self, name: str) -> ConversationDict:
+		'''Returns the conversations from Redis, a view reading every state from Redis if replicated.'''
+		if self.replicated:
+			return RedisConversations(self, name)
+		return super().get_conversations(name)
+
+	def read_conversation(self, name: str, key: Tuple[int, ...]) -> Optional[object]:
+		'''Reads the current state of a conversation from Redis.'''
+		field = self._conversation_field(name, key)
+		raw = self.redis.hget(self._key('conversations'), field)
+		state = self.codec.decode(raw) if raw else None
+		with self._lock:
+			self._ensure_loaded('conversations')
+			self.conversations.setdefault(name, {})[key] = state
+			if raw:
+				self._written['conversations'][field] = raw
+			else:
+				self._written['conversations'].pop(field, None)
+		return state
+
+	def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+		'''Reloads the user_data changed by other replicas.'''
+		if not self.replicated:
+			return
+		field = str(user_id)
+		raw = self.redis.hget(self._key('user_data'), field)
+		with self._lock:
+			if raw == self._written['user_data'].get(field):
+				return
+			user_data.clear()
+			if raw:
+				user_data.update(self.codec.decode(raw))
+				self._written['user_data'][field] = raw
+			else:
+				self._written['user_data'].pop(field, None)
+
+	def refresh_bot_data(self, bot_data: Dict) -> None:
+		'''Reloads parties and guests changed or archived by other replicas.'''
+		if not self.replicated:
+			return
+		version = self.redis.get(self._key('version'))
+		if version == self._version:
+			return
+		# Under the lock the entries read here can't be overwritten by writes of this process that
+		# are already staged but not yet recorded as written
+		with self.guests_lock, self._lock:
+			pipe = self.redis.pipeline()
+			pipe.get(self._key('bot_data'))
+			pipe.hgetall(self._key('parties'))
+			pipe.smembers(self._key('archived'))
+			bot_raw, parties_raw, archived = pipe.execute()
+			parties_raw = {field.decode(): raw for field, raw in parties_raw.items()}
+			pipe = self.redis.pipeline()
+			for party_id in parties_raw:
+				pipe.hgetall(self._key(self._versions_section(party_id)))
+			remote_versions = {party_id: {field.decode(): int(value) for field, value in versions_raw.items()}
+				for party_id, versions_raw in zip(parties_raw, pipe.execute())}
+			changed = {}
+			for party_id, versions in remote_versions.items():
+				local_versions = self._guest_versions[party_id]
+				fields = [field for field, value in versions.items() if local_versions.get(field, 0) < value]
+				if fields:
+					changed[party_id] = fields
+			pipe = self.redis.pipeline()
+			for party_id, fields in changed.items():
+				pipe.hmget(self._key(self._guests_section(party_id)), fields)
+			fetched = pipe.execute()
+
+			if bot_raw and bot_raw != self._written['bot_data'].get(''):
+				self._written['bot_data'][''] = bot_raw
+				bot_data.update(self.codec.decode(bot_raw))
+			parties = bot_data.setdefault('parties', {})
+			for party_id in archived:
+				party_id = party_id.decode()
+				if party_id in parties:
+					del parties[party_id]
+					self._forget_party(party_id)
+			for party_id, raw in parties_raw.items():
+				if raw != self._written['parties'].get(party_id):
+					self._written['parties'][party_id] = raw
+					parties.setdefault(party_id, {'guests': {}}).update(self.codec.decode(raw))
+			changes: Dict[str, Dict[int, Dict]] = {}
+			for (party_id, fields), raws in zip(changed.items(), fetched):
+				section = self._guests_section(party_id)
+				for field, raw in zip(fields, raws):
+					if raw is None:
+						continue
+					changes.setdefault(party_id, {})[int(field)] = self.codec.decode(raw)
+					self._written[section][field] = raw
+					self._guest_versions[party_id][field] = remote_versions[party_id][field]
+			self._version = version
+			if changes and self.guests_listener:
+				self.guests_listener(bot_data, changes)
+			else:
+				for party_id, guests in changes.items():
+					if party_id in parties:
+						parties[party_id].setdefault('guests', {}).update(guests)
+
+	def update_guest(self, party_id: str, user_id: int, mutate: Callable[[Optional[Dict]], Dict],
+			apply: Optional[Callable[[Dict], None]] = None) -> Dict:
+		'''Applies ``mutate`` to the guest record stored in Redis and writes the result only if nobody
+		changed the record in between, otherwise reads it again and retries. Returns the new record.
+
+		No lock is held meanwhile. ``apply`` is then called with the new record under :attr:`guests_lock`,
+		unless a newer record written by another replica was already applied by :meth:`refresh_bot_data`.'''
+		field = str(user_id)
+		section = self._guests_section(party_id)
+		keys = [self._key(section), self._key(self._versions_section(party_id)), self._key('version')]
+		for _ in range(self.max_retries):
+			started = time.perf_counter()
+			current = self.redis.hget(keys[0], field)
+			guest = mutate(self.codec.decode(current) if current else None)
+			data_bytes = self.codec.encode(guest)
+			version = self._guest_cas(keys=keys, args=[field, current or b'', data_bytes])
+			if version:
+				with self.guests_lock, self._lock:
+					if self._guest_versions[party_id].get(field, 0) < int(version):
+						self._written[section][field] = data_bytes
+						self._guest_versions[party_id][field] = int(version)
+						if apply:
+							apply(guest)
+				self._record_flush(1, len(data_bytes), time.perf_counter() - started)
+				return guest
+		raise WatchError(f'Guest {user_id} was changed concurrently {self.max_retries} times in a row')
+
+	def archive_party(self, party: Dict) -> None:
+		'''Moves the party with its guests to a single archive key, out of the loaded state.'''
+		party_id = party['id']
+		commands = [
+			('set', self._key(f'archive:{party_id}'), self.codec.encode(party)),
+			('sadd', self._key('archived'), party_id),
+			('hdel', self._key('parties'), party_id),
+			('delete', self._key(self._guests_section(party_id)), self._key(self._versions_section(party_id)),
+				self._key(self._deposit_section(party_id)), self._analytics_key(party_id)),
+		]
+		if self.replicated:
+			commands.append(('incr', self._key('version')))
+		self._send(commands)
+		with self._lock:
+			self._forget_party(party_id)
+
+	def load_archived_party(self, party_id: str) -> Optional[Dict]:
+		data = self.redis.get(self._key(f'archive:{party_id}'))
+		return self.codec.decode(data) if data else None
+
+	def _forget_party(self, party_id: str) -> None:
+		self._forget_analytics(party_id)
+		self._written['parties'].pop(party_id, None)
+		self._written.pop(self._guests_section(party_id), None)
+		self._guest_versions.pop(party_id, None)
+
+	def acquire_lock(self, name: str, ttl: int) -> bool:
+		'''Returns True for the only replica that takes the named lock until it expires.'''
+		return bool(self.redis.set(self._key(f'lock:{name}'), 1, nx=True, ex=ttl))
+
+	def seed_deposit(self, party_id: str, spent: int) -> None:
+		'''Starts the deposit counter of the party at the amount already ordered, unless it is started.'''
+		self.redis.set(self._key(self._deposit_section(party_id)), spent, nx=True)
+
+	def reserve_deposit(self, party_id: str, amount: int, limit: int) -> Tuple[bool, int]:
+		'''Adds the amount to the deposit counter of the party if the counter stays within the limit, or
+		in any case if the limit is negative. Returns whether it was added and the counter, atomically
+		for all replicas.'''
+		added, spent = self._deposit_reserve(keys=[self._key(self._deposit_section(party_id))], args=[amount, limit])
+		return bool(added), int(spent)
+
+	def release_deposit(self, party_id: str, amount: int) -> int:
+		return int(self.redis.decrby(self._key(self._deposit_section(party_id)), amount))
+
+	def get_deposit_spent(self, party_id: str) -> int:
+		return int(self.redis.get(self._key(self._deposit_section(party_id))) or 0)
@@ -0,0 +1,128 @@
+import io
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from pypdf import PdfReader
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import billing
+import metrics
+import reports
+
+
+logger = logging.getLogger(__file__)
+
+MAX_FILE_SIZE = 5 * 2 ** 20
+# Amounts like 1250, 1 250,00 or 1250.00 not being a part of a date or
+# an account number
+AMOUNT = re.compile(r'(?<![\d.,])(\d{1,3}(?:[ \u00a0\u202f]\d{3})+|\d+)'
+                    r'(?:[.,](\d{2}))?(?![\d.,]?\d)\s*(₽|руб|р\.|rub)?',
+                    re.IGNORECASE)
+KEYWORDS = ('сумма', 'итого', 'к оплате', 'переведено', 'списано',
+            'оплачено', 'total', 'amount', 'paid')
+
+# Set up with the dispatcher
+receipt_matcher = None
+
+
+def extract_text(data):
+    reader = PdfReader(io.BytesIO(data))
+    return '\n'.join(page.extract_text() or '' for page in reader.pages)
+
+
+def find_amounts(text):
+    '''Returns the amounts with a currency or on the lines naming a sum.'''
+    amounts = set()
+    for line in text.splitlines():
+        keyword_line = any(keyword in line.lower() for keyword in KEYWORDS)
+        for match in AMOUNT.finditer(line):
+            integer, fraction, currency = match.groups()
+            if currency or keyword_line:
+                amounts.add(Decimal(re.sub(r'\D', '', integer)
+                                    + '.' + (fraction or '00')))
+    return amounts
+
+
+def format_amounts(amounts):
+    return ', '.join(f'{amount:f}'.replace('.00', '') + 'руб.'
+                     for amount in sorted(amounts))
+
+
+class ReceiptMatcher:
+    '''Checks the payment receipts guests send on a pool of threads.
+
+    A PDF receipt is downloaded and the amounts found in its text are compared
+    with the guest's total. On an exact match the bill is marked paid and the
+    guest is told so, anything else is forwarded to the admin chat with the
+    amounts found and a button to mark the bill paid by hand.
+    '''
+
+    def __init__(self, bot, workers=2):
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(workers,
+                                           thread_name_prefix='ReceiptWorker')
+        self.duration = metrics.get_histogram('receipts.check')
+
+    def submit(self, party, user_id, message):
+        self.executor.submit(self.process, party, user_id, message)
+
+    def process(self, party, user_id, message):
+        start = time.perf_counter()
+        try:
+            outcome = self.check(party, user_id, message)
+        except Exception:
+            logger.exception('Receipt not checked')
+            outcome = 'failed'
+        if outcome == 'failed':
+            try:
+                self.escalate(party, user_id, message,
+                              'чек не удалось проверить')
+            except Exception:
+                logger.exception('Receipt not forwarded')
+        metrics.increment(f'receipts.{outcome}')
+        self.duration.observe(time.perf_counter() - start,
+                              error=outcome == 'failed')
+
+    def check(self, party, user_id, message):
+        guest = party['guests'].get(user_id)
+        document = message.document
+        if guest is None or guest.bill_payd or not guest.subtotal:
+            self.escalate(party, user_id, message, None)
+            return 'skipped'
+        if document.mime_type != 'application/pdf' \
+                or (document.file_size or 0) > MAX_FILE_SIZE:
+            self.escalate(party, user_id, message, 'чек не в формате PDF')
+            return 'unreadable'
+        data = self.bot.get_file(document.file_id).download_as_bytearray()
+        amounts = find_amounts(extract_text(bytes(data)))
+        if not amounts:
+            self.escalate(party, user_id, message, 'сумма в чеке не найдена')
+            return 'unreadable'
+        if Decimal(guest.subtotal) not in amounts:
+            self.escalate(party, user_id, message,
+                          f'в чеке {format_amounts(amounts)}')
+            return 'mismatched'
+        billing.mark_paid(party, user_id)
+        self.bot.send_message(chat_id=message.chat_id,
+                              text=f'Оплата {guest.subtotal}руб. получена, '
+                                   'спасибо!')
+        return 'matched'
+
+    def escalate(self, party, user_id, message, reason):
+        message.forward(party['admin_chat_id'])
+        guest = party['guests'].get(user_id)
+        if reason is None or guest is None:
+            return
+        text = f'Чек гостя {reports.format_guest_name(guest.name)}: ' \
+               f'{reason}, к оплате {guest.subtotal}руб.\n' \
+               f'Счет не оплачен.'
+        keyboard = [[InlineKeyboardButton(
+            '✅ Отметить оплату 💰', callback_data=f'closebill:{user_id}')]]
+        self.bot.send_message(chat_id=party['admin_chat_id'], text=text,
+                              reply_markup=InlineKeyboardMarkup(keyboard))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,116 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import billing
+
+
+MESSAGE_LIMIT = 4096
+GUESTS_PER_PAGE = 10
+REPORT_TITLES = {
+    'total': 'Общая сумма за вечер',
+    'debtors': 'Сумма неоплаченных счетов',
+}
+
+
+def format_guest_name(name):
+    username, firstname, lastname = name
+    summary_name = f'{firstname} ' if firstname else ''
+    summary_name += f'{lastname}' if lastname else ''
+    summary_name += f'(@{username})' if username else ''
+    return summary_name
+
+
+def format_guest_summary(guest, limit=MESSAGE_LIMIT):
+    text = f'Гость {format_guest_name(guest.name)}:\n'
+    for item, cost in guest.orders:
+        text += f'\t{item} - {cost}руб.\n'
+    footer = f'User total: {guest.subtotal}руб.\n'
+    negate_payd = '' if guest.bill_payd else 'не '
+    footer += f'Счет {negate_payd}оплачен.\n'
+    if not guest.bill_payd:
+        negate_sent = '' if guest.bill_sent else 'не '
+        footer += f'Счет {negate_sent}отправлен.\n'
+    if len(text) + len(footer) > limit:
+        text = text[:limit - len(footer) - 2] + '…\n'
+    return text + footer
+
+
+def get_report_guests(party, kind):
+    if kind == 'debtors':
+        return sorted(billing.get_ledger(party)['unpaid'])
+    return sorted(party['guests'])
+
+
+def paginate(party, user_ids, header_limit):
+    '''Packs guest summaries into pages that fit a single message.'''
+    limit = MESSAGE_LIMIT - header_limit
+    pages = []
+    page, page_length = [], 0
+    for user_id in user_ids:
+        summary = format_guest_summary(party['guests'][user_id], limit)
+        if page and (page_length + len(summary) + 1 > limit
+                     or len(page) >= GUESTS_PER_PAGE):
+            pages.append(page)
+            page, page_length = [], 0
+        page.append((user_id, summary))
+        page_length += len(summary) + 1
+    if page or not pages:
+        pages.append(page)
+    return pages
+
+
+def render_report(party, kind, page_number):
+    '''Returns text and keyboard of one page of the /total or /debtors report.'''
+    with billing.lock:
+        ledger = billing.get_ledger(party)
+        amount = ledger['unpaid_total'] if kind == 'debtors' \
+            else ledger['total']
+        header = f'{REPORT_TITLES[kind]}: {amount}руб.\n'
+        header_limit = len(header) + 32
+        pages = paginate(party, get_report_guests(party, kind), header_limit)
+    page_number = min(max(page_number, 0), len(pages) - 1)
+    page = pages[page_number]
+
+    header += f'Страница {page_number + 1} из {len(pages)}\n\n'
+    text = header + '\n'.join(summary for _, summary in page)
+
+    keyboard = []
+    for user_id, _ in page:
+        guest = party['guests'][user_id]
+        if guest.bill_payd:
+            continue
+        name = format_guest_name(guest.name)
+        context_data = f'{user_id}:{kind}:{page_number}'
+        keyboard.append([
+            InlineKeyboardButton(f'✉ {name}',
+                                 callback_data=f'sendbill:{context_data}'),
+            InlineKeyboardButton(f'✅ {name}',
+                                 callback_data=f'closebill:{context_data}'),
+        ])
+    if len(pages) > 1:
+        keyboard.append([
+            InlineKeyboardButton(
+                '◀', callback_data=f'report:{kind}:{max(page_number - 1, 0)}'),
+            InlineKeyboardButton(f'{page_number + 1}/{len(pages)}',
+                                 callback_data=f'report:{kind}:{page_number}'),
+            InlineKeyboardButton(
+                '▶', callback_data=f'report:{kind}:'
+                                   f'{min(page_number + 1, len(pages) - 1)}'),
+        ])
+    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    return text, reply_markup
+
+
+def format_user_bill(guest):
+    text = f'Гость {format_guest_name(guest.name)}:\n'
+    for item, cost in guest.orders:
+        text += f'\t{item} - {cost}руб.\n'
+    text += f'User total: {guest.subtotal}руб.\n'
+    text += 'Счет оплачивать переводом на номер 89110327182 (Сбер или ' \
+            'Тинькофф)\nПосле оплаты чек из банковского приложения отправь ' \
+            'сюда боту.\nОбычно приложение отправляет чек в формате PDF, но ' \
+            'если ты захочешь отправить скриншот экрана, то отправляй ' \
+            'картинку БЕЗ сжатия.\n'
+    negate_payd = '' if guest.bill_payd else 'не '
+    text += f'Счет {negate_payd}оплачен.\n'
+    text += 'Счет отправлен.\n'
+    return text
@@ -0,0 +1,33 @@
+import time
+from queue import Queue
+
+from telegram.ext import Dispatcher, JobQueue
+
+from fake_redis import FakeRedis
+from load_test import FakeBot
+from persistence import ShardedRedisPersistence
+
+
+def test_idle_job_queue_does_not_keep_flushing():
+    persistence = ShardedRedisPersistence(
+        FakeRedis(), write_behind=True, flush_interval=1,
+        flush_threshold=100)
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(FakeBot(), Queue(), job_queue=job_queue,
+                            persistence=persistence)
+    job_queue.set_dispatcher(dispatcher)
+    persistence.start_write_behind(job_queue)
+    for user_id in range(300):
+        dispatcher.user_data[user_id]['party_id'] = '1000'
+        dispatcher.chat_data[user_id]['seen'] = True
+    # Like the broadcast tick, every job run updates the persistence
+    job_queue.run_repeating(lambda context: None, interval=0.1)
+    job_queue.start()
+    try:
+        dispatcher.update_persistence()
+        time.sleep(3)
+    finally:
+        job_queue.stop()
+    # The first write of the users plus the periodic ones at most
+    assert persistence.stats['flushes'] <= 4
+    assert persistence.stats['entries_written'] == 600